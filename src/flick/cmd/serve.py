@@ -9,7 +9,11 @@ from loguru import logger
 from tornado import autoreload, httpserver, ioloop, web
 
 from flick.common import log
+from flick.core import container, exceptions
+from flick.core import node as node_core
+from flick.core import pip as pip_core
 from flick.router import auth, base, docker, node, pip, sse, webrequest
+from flick.service import sse as sse_service
 
 
 class ServeCommand(Command):
@@ -21,6 +25,7 @@ class ServeCommand(Command):
         option("webview", "w", flag=True, description="Enable webview mode"),
         option("host", flag=False, default="127.0.0.1", description="Host"),
         option("port", flag=False, default=5000, description="Port"),
+        option("pip-proxy", flag=True, description="Install pip packages through the local cache"),
     ]
 
     def handle(self):
@@ -75,23 +80,37 @@ class ServeCommand(Command):
             (r"/node/memory", node.Memory),
             (r"/node/partitions", node.Partitions),
             (r"/node/net_interfaces", node.NetInterfaces),
+            (r"/node/metrics", node.Metrics),
+            (r"/node/telemetry", node.Telemetry),
             (r"/pip/version", pip.Version),
+            (r"/pip/outdated", pip.Outdated),
+            (r"/pip/batch", pip.Batch),
+            (r"/pip/jobs", pip.Jobs),
+            (r"/pip/jobs/([^/]+)", pip.Job),
             (r"/pip/packages", pip.Packages),
             (r"/pip/packages/([^/]+)/versions", pip.PackageVersion),
             (r"/pip/packages/([^/]+)", pip.Package),
             (r"/pip/repos", pip.Repos),
+            (r"/pip/cache", pip.Cache),
+            (r"/pip/simple/([^/]+)/", pip.SimpleIndex),
+            (r"/pip/simple/([^/]+)/([^/]+)", pip.SimpleFile),
             (r"/pip/config", pip.Config),
             (r"/docker/system", docker.System),
             (r"/docker/images", docker.Images),
+            (r"/docker/mirrors", docker.Mirrors),
             (r"/docker/images/([^/]+)", docker.Image),
             (r"/docker/images/([^/]+)/tags/(.+)", docker.ImageTag),
             (r"/docker/images/([^/]+)/tags", docker.ImageTags),
             (r"/docker/containers", docker.Containers),
+            (r"/docker/container-actions", docker.ContainerActions),
+            (r"/docker/container-stats", docker.ContainerStats),
             (r"/docker/containers/([^/]+)", docker.Container),
+            (r"/docker/containers/([^/]+)/logs", docker.ContainerLogs),
             (r"/docker/volumes", docker.Volumes),
             (r"/docker/volumes/([^/]+)", docker.Volume),
             (r"/webrequest/requests", webrequest.Requests),
             (r"/webrequest/requests/([0-9]+)", webrequest.Request),
+            (r"/webrequest/requests/([0-9]+)/cancel", webrequest.RequestCancel),
             (r"/assets/(.*)", web.StaticFileHandler, {"path": os.path.join(web_dir, "assets")}),
         ]
         app = web.Application(
@@ -102,11 +121,23 @@ class ServeCommand(Command):
             compress_response=False,
             cookie_secret="YOUR_SECURE_KEY",
         )
+        try:
+            # DOCKER_HOST 不受支持或 TLS 证书无法加载时在启动时报错, 而不是等到第一次请求
+            container.SERVICE.api.client  # pylint: disable=pointless-statement
+        except exceptions.CreateDockerClientFailed as e:
+            logger.error("{}", e)
+            return 1
         http_server = httpserver.HTTPServer(app)
         http_server.listen(self.option("port"))
         logger.info("starting server at {}", self.option("port"))
         if self.option("dev"):
             autoreload.start()
+        if self.option("pip-proxy"):
+            pip_core.SERVICE.proxy_url = f"http://127.0.0.1:{self.option('port')}/pip/simple/"
+            logger.info("install pip packages through {}", pip_core.SERVICE.proxy_url)
+        node_core.SERVICE.metrics.start()
+        ioloop.IOLoop.current().add_callback(container.SERVICE.puller.start_probe)
+        ioloop.IOLoop.current().add_callback(sse_service.SSE_SERVICE.start)
         ioloop.IOLoop.current().start()
 
         # if self.option("webview"):
@@ -0,0 +1,60 @@
+import asyncio
+import pathlib
+import threading
+from typing import Callable, List, Optional
+
+import tinydb
+from loguru import logger
+from tinydb import middlewares, storages
+
+
+class TableSaver:
+    """把内存中的数据整体写入 tinydb 的一张表
+
+    schedule 把 delay 秒内的多次修改合并为一次写入, 在线程池中执行, 不阻塞事件循环;
+    每次写入只序列化一次整个文件。
+    """
+
+    def __init__(
+        self, db_file: pathlib.Path, table: str, dump: Callable[[], List[dict]], delay: float = 1
+    ) -> None:
+        self.db_file = db_file
+        self.table = table
+        self.dump = dump
+        self.delay = delay
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._lock = threading.Lock()
+
+    def schedule(self):
+        if self._handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._handle = loop.call_later(self.delay, self._flush)
+
+    def _flush(self):
+        self._handle = None
+        # 在事件循环线程中复制数据, 线程池中只负责写入
+        asyncio.get_running_loop().run_in_executor(None, self._write, self.dump())
+
+    def save(self):
+        """立即同步写入"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._write(self.dump())
+
+    def _write(self, docs: List[dict]):
+        with self._lock:
+            try:
+                self.db_file.parent.mkdir(parents=True, exist_ok=True)
+                storage = middlewares.CachingMiddleware(storages.JSONStorage)
+                with tinydb.TinyDB(self.db_file, storage=storage) as db:
+                    table = db.table(self.table)
+                    table.truncate()
+                    table.insert_multiple(docs)
+            except (OSError, ValueError) as e:
+                logger.warning("save {} failed: {}", self.db_file, e)
@@ -29,9 +29,23 @@ def strtobool(value: str) -> bool:
     return value.lower() in ("true", "1", "yes", "on")
 
 
+def _writable(path: pathlib.Path) -> bool:
+    while not path.exists():
+        path = path.parent
+    return os.access(path, os.W_OK)
+
+
+@lru_cache(maxsize=None)
 def data_path(app_name: str) -> pathlib.Path:
-    """获取数据目录下的文件路径"""
+    """获取数据目录下的文件路径
+
+    默认为 /usr/share, 没有写权限时 (例如非 root 用户) 使用用户数据目录。
+    """
     appdir = os.getenv("APPDIR")
-    if not appdir:
-        appdir = "/usr/share"
-    return pathlib.Path(appdir, app_name)
+    if appdir:
+        return pathlib.Path(appdir, app_name)
+    path = pathlib.Path("/usr/share", app_name)
+    if _writable(path):
+        return path
+    user_dir = os.getenv("XDG_DATA_HOME") or pathlib.Path.home().joinpath(".local", "share")
+    return pathlib.Path(user_dir, app_name)
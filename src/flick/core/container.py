@@ -1,17 +1,20 @@
+import asyncio
 import dataclasses
-from typing import Dict, List, Literal, Optional
+import inspect
+import pathlib
+import re
+import shlex
+import time
+from typing import Any, Callable, Dict, List, Literal, Optional, Set, Tuple
 
-import docker
 import docker.errors
-import requests.exceptions
-import urllib3.exceptions
-from docker.models import containers as docker_containers
-from docker.models import images as docker_images
-from docker.models import volumes as docker_volumes
+import httpx
+import tinydb
 from loguru import logger
-from retry import retry
 
-from . import exceptions
+from flick.common import storage, utils
+
+from . import docker_api, exceptions
 
 
 @dataclasses.dataclass
@@ -22,6 +25,8 @@ class Container:
     image: str = ""
     command: List[str] = dataclasses.field(default_factory=list)
     autoRemove: Optional[bool] = None
+    id: str = ""
+    labels: Dict[str, str] = dataclasses.field(default_factory=dict)
 
     def is_running(self) -> bool:
         return self.status in ["running", "active"]
@@ -30,14 +35,18 @@ class Container:
         return dataclasses.asdict(self)
 
     @classmethod
-    def from_raw_object(cls, container: docker_containers.Container):
+    def from_raw_object(cls, attrs: dict):
+        """由 docker API 返回的容器详情 (inspect) 构造"""
+        state = attrs.get("State")
         return Container(
-            short_id=container.short_id,
-            name=container.name or "",
-            status=container.status or "",
-            image=container.attrs.get("Config", {}).get("Image", ""),
-            command=container.attrs.get("Config", {}).get("Cmd", []),
-            autoRemove=container.attrs.get("HostConfig", {}).get("AutoRemove", []),
+            id=attrs["Id"],
+            short_id=attrs["Id"][:12],
+            name=(attrs.get("Name") or "").lstrip("/"),
+            status=(state.get("Status") if isinstance(state, dict) else state) or "",
+            image=(attrs.get("Config") or {}).get("Image", ""),
+            command=(attrs.get("Config") or {}).get("Cmd") or [],
+            autoRemove=(attrs.get("HostConfig") or {}).get("AutoRemove"),
+            labels=(attrs.get("Config") or {}).get("Labels") or {},
         )
 
 
@@ -47,14 +56,20 @@ class Image:
     tags: List[str]
     size: int
     id: Optional[str] = None
+    labels: Dict[str, str] = dataclasses.field(default_factory=dict)
+
+    def to_json(self):
+        return dataclasses.asdict(self)
 
     @classmethod
-    def from_raw_object(cls, image: docker_images.Image):
+    def from_raw_object(cls, attrs: dict):
+        image_id: str = attrs["Id"]
         return Image(
-            short_id=image.short_id,
-            id=image.id,
-            tags=image.tags,
-            size=image.attrs["Size"],
+            short_id=image_id[:19] if image_id.startswith("sha256:") else image_id[:12],
+            id=image_id,
+            tags=[tag for tag in attrs.get("RepoTags") or [] if tag != "<none>:<none>"],
+            size=attrs["Size"],
+            labels=attrs.get("Labels") or (attrs.get("Config") or {}).get("Labels") or {},
         )
 
 
@@ -68,37 +83,649 @@ class Volume:
     labels: Optional[Dict[str, str]] = None
 
     @classmethod
-    def from_raw_object(cls, volume: docker_volumes.Volume):
+    def from_raw_object(cls, attrs: dict):
         return Volume(
-            short_id=volume.short_id,
-            name=volume.name,
-            labels=volume.attrs.get("Labels") or {},
-            driver=volume.attrs["Driver"],
-            mountpoint=volume.attrs["Mountpoint"],
-            created_at=volume.attrs["CreatedAt"],
+            short_id=attrs["Name"][:12],
+            name=attrs["Name"],
+            labels=attrs.get("Labels") or {},
+            driver=attrs["Driver"],
+            mountpoint=attrs["Mountpoint"],
+            created_at=attrs.get("CreatedAt", ""),
         )
 
 
-class DockerManager:
+def match_labels(labels: Optional[Dict[str, str]], selector: Optional[str]) -> bool:
+    """selector 格式为 key 或 key=value"""
+    if not selector:
+        return True
+    key, sep, value = selector.partition("=")
+    if not labels or key not in labels:
+        return False
+    return not sep or labels[key] == value
+
+
+# 镜像加速地址, 拉取镜像时与 Docker Hub 同时尝试
+REGISTRY_MIRRORS = [
+    "docker-0.unsee.tech",
+    "docker.m.daocloud.io",
+    "docker.hlmirror.com",
+    "docker-mirror.aigc2d.com",
+    "dockertest.jsdelivr.fyi",
+    "docker.ameke.cn",
+    "docker.1ms.run",
+]
+
+DOCKER_HUB = "docker.io"
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+
+# 支持批量执行的容器操作
+CONTAINER_ACTIONS = ["start", "stop", "restart", "pause", "unpause", "remove"]
+
+# docker 容器事件与事件发生后的容器状态
+CONTAINER_EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "destroy": "removed",
+}
+
+
+class EventWatcher:
+    """订阅 docker /events, 并将事件分发给监听者
+
+    断线后使用最后一个事件的时间作为 since 重新订阅。daemon 重启等情况下断开期间的事件
+    可能无法补齐, 所以重连成功后还会通知 reconnect 监听者重新加载。
+    """
+
+    def __init__(self, api: docker_api.DockerAPI, retry_interval: float = 3) -> None:
+        self.api = api
+        self.retry_interval = retry_interval
+        self._listeners: List[Callable[[dict], Any]] = []
+        self._reconnect_listeners: List[Callable[[], Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._since: Optional[int] = None
+        self.connected = False
+
+    def add_listener(self, listener: Callable[[dict], Any]):
+        self._listeners.append(listener)
+
+    def add_reconnect_listener(self, listener: Callable[[], Any]):
+        self._reconnect_listeners.append(listener)
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        if self._since is None:
+            self._since = int(time.time())
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        broken = False
+        while True:
+            try:
+                logger.info("subscribe docker events since {}", self._since)
+                async with self.api.stream("GET", "/events", params={"since": self._since}) as resp:
+                    self.connected = True
+                    if broken:
+                        broken = False
+                        self._reconnected()
+                    async for event in docker_api.iter_json(resp):
+                        self._since = event.get("time", self._since)
+                        await self._dispatch(event)
+            except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+                logger.warning("docker events stream broken: {}", e)
+            self.connected = False
+            broken = True
+            await asyncio.sleep(self.retry_interval)
+
+    def _reconnected(self):
+        for listener in self._reconnect_listeners:
+            try:
+                listener()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("handle docker events reconnect failed")
+
+    async def _dispatch(self, event: dict):
+        for listener in self._listeners:
+            try:
+                result = listener(event)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("handle docker event failed: {}", event)
+
+
+class ContainerStates:
+    """由 docker 事件驱动的容器状态表
+
+    等待者是事件循环上的 future, 事件到达时立即被唤醒, 不占用线程。
+    """
 
     def __init__(self) -> None:
-        self._client = None
+        self._states: Dict[str, str] = {}
+        self._waiters: Dict[str, List[Tuple[List[str], asyncio.Future]]] = {}
+
+    def get(self, container_id: str) -> Optional[str]:
+        return self._states.get(container_id)
+
+    def on_event(self, event: dict):
+        if event.get("Type") != "container":
+            return
+        action = (event.get("Action") or "").split(":")[0]
+        status = CONTAINER_EVENT_STATUS.get(action)
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        if status and container_id:
+            logger.debug("container {} {} -> {}", container_id[:12], action, status)
+            self.update(container_id, status)
+
+    def update(self, container_id: str, status: str, only_unknown=False):
+        if only_unknown and container_id in self._states:
+            return
+        if status == "removed":
+            self._states.pop(container_id, None)
+        else:
+            self._states[container_id] = status
+        pending = []
+        for expect, fut in self._waiters.pop(container_id, []):
+            if status == "removed" or status in expect:
+                if not fut.done():
+                    fut.set_result(status)
+            else:
+                pending.append((expect, fut))
+        if pending:
+            self._waiters[container_id] = pending
+
+    async def wait(self, container_id: str, expect: List[str], timeout: float = 60) -> str:
+        """等待容器进入 expect 中的任一状态, 容器被删除时返回 removed"""
+        status = self._states.get(container_id)
+        if status in expect:
+            return status  # type: ignore
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(container_id, []).append((expect, fut))
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError as e:
+            raise exceptions.ContainerStatusNotMatch(
+                container_id, self._states.get(container_id) or "", expect
+            ) from e
+        finally:
+            pending = [item for item in self._waiters.pop(container_id, []) if item[1] is not fut]
+            if pending:
+                self._waiters[container_id] = pending
+
+
+class Inventory:
+    """容器/镜像/卷的清单缓存
+
+    首次访问时全量加载, 之后根据 docker 事件只刷新发生变化的对象。
+    事件流断开期间缓存被标记为不同步, 重连后重新全量加载, 加载完成前仍然是不同步的。
+    """
+
+    KINDS = ("containers", "images", "volumes")
+    # 不影响清单内容的事件
+    IGNORE_ACTIONS = {
+        "attach", "exec_create", "exec_start", "exec_die", "health_status", "top", "resize",
+        "archive-path", "extract-to-dir", "export", "mount", "unmount",
+    }
+
+    def __init__(self, manager: "DockerManager") -> None:
+        self.manager = manager
+        self._items: Dict[str, Dict[str, Any]] = {kind: {} for kind in self.KINDS}
+        self._loaded_at: Dict[str, float] = {}
+        # 全量加载期间收到事件的对象, 加载完成后需要重新刷新
+        self._loading: Dict[str, set] = {}
+        self._load_locks = {kind: asyncio.Lock() for kind in self.KINDS}
+        self._last_event_at: Optional[float] = None
+        self._reloads: Set[asyncio.Task] = set()
+
+    async def list(self, kind: str, refresh=False) -> list:
+        if refresh or kind not in self._loaded_at:
+            await self.load(kind, force=refresh)
+        return list(self._items[kind].values())
+
+    async def load(self, kind: str, force=True):
+        async with self._load_locks[kind]:
+            # 并发的请求等待同一次加载
+            if not force and kind in self._loaded_at:
+                return
+            logger.info("load {} inventory", kind)
+            self.manager.watcher.start()
+            self._loading[kind] = set()
+            try:
+                items = await self._fetch_all(kind)
+            finally:
+                changed = self._loading.pop(kind, set())
+            self._items[kind] = items
+            self._loaded_at[kind] = time.time()
+        for key in changed:
+            await self._patch(kind, key)
+
+    def status(self, kind: str) -> dict:
+        loaded_at = self._loaded_at.get(kind)
+        return {
+            "synced": self.manager.watcher.connected and kind in self._loaded_at,
+            "loaded_at": loaded_at,
+            "age": time.time() - loaded_at if loaded_at else None,
+            "last_event_at": self._last_event_at,
+        }
+
+    def on_reconnect(self):
+        """事件流重新连接后, 已加载的清单作废并在后台重新加载"""
+        kinds = list(self._loaded_at)
+        self._loaded_at.clear()
+        for kind in kinds:
+            logger.info("docker events reconnected, reload {} inventory", kind)
+            task = asyncio.get_running_loop().create_task(self._reload(kind))
+            self._reloads.add(task)
+            task.add_done_callback(self._reloads.discard)
+
+    async def _reload(self, kind: str):
+        try:
+            await self.load(kind, force=False)
+        except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+            # 下一次访问时重新加载
+            logger.warning("reload {} inventory failed: {}", kind, e)
+
+    async def on_event(self, event: dict):
+        kind = {"container": "containers", "image": "images", "volume": "volumes"}.get(
+            event.get("Type", "")
+        )
+        key = event.get("id") or event.get("Actor", {}).get("ID")
+        if not kind or not key:
+            return
+        self._last_event_at = time.time()
+        if kind in self._loading:
+            self._loading[kind].add(key)
+        if kind not in self._loaded_at:
+            return
+        action = (event.get("Action") or "").split(":")[0]
+        if action in ["destroy", "delete"]:
+            self._items[kind].pop(key, None)
+        elif action not in self.IGNORE_ACTIONS:
+            await self._patch(kind, key)
+
+    async def _patch(self, kind: str, key: str):
+        try:
+            item = await self._fetch_one(kind, key)
+        except docker.errors.NotFound:
+            self._items[kind].pop(key, None)
+            return
+        self._items[kind][self._key(kind, item)] = item
+
+    @staticmethod
+    def _key(kind: str, item) -> str:
+        return item.name if kind == "volumes" else item.id
+
+    async def _fetch_all(self, kind: str) -> Dict[str, Any]:
+        if kind == "containers":
+            items = await self.manager.fetch_containers()
+        elif kind == "images":
+            items = await self.manager.fetch_images()
+        else:
+            items = await self.manager.fetch_volumes()
+        return {self._key(kind, item): item for item in items}
+
+    async def _fetch_one(self, kind: str, key: str):
+        if kind == "containers":
+            return await self.manager.get_container(key)
+        if kind == "images":
+            return await self.manager.get_image(key)
+        return await self.manager.get_volume(key)
+
+
+def parse_image(image: str) -> Tuple[str, str]:
+    """将镜像名拆分为 repository 和 tag"""
+    name, _, digest = image.partition("@")
+    if digest:
+        return name, f"@{digest}"
+    repository, sep, tag = name.rpartition(":")
+    if not sep or "/" in tag:
+        return name, "latest"
+    return repository, tag
+
+
+def is_docker_hub_image(repository: str) -> bool:
+    first = repository.split("/")[0]
+    return "/" not in repository or not ("." in first or ":" in first or first == "localhost")
+
+
+@dataclasses.dataclass
+class MirrorScore:
+    host: str
+    latency: Optional[float] = None
+    throughput: Optional[float] = None
+    failure_rate: float = 0
+    probes: int = 0
+    pulls: int = 0
+    updated_at: float = 0
+
+    # 估算代价时使用的镜像大小, 以及尚未测得的延迟和吞吐量
+    REFERENCE_SIZE = 50 * 1024 * 1024
+    UNKNOWN_LATENCY = 1.0
+    UNKNOWN_THROUGHPUT = 5 * 1024 * 1024
+
+    def cost(self) -> float:
+        """预计拉取参考大小镜像的时间, 越小越好"""
+        cost = self.UNKNOWN_LATENCY if self.latency is None else self.latency
+        cost += self.REFERENCE_SIZE / (self.throughput or self.UNKNOWN_THROUGHPUT)
+        return cost / max(1 - self.failure_rate, 0.05)
+
+    def to_json(self):
+        return dict(dataclasses.asdict(self), cost=self.cost())
+
+
+class MirrorScoreboard:
+    """镜像加速地址的评分表
+
+    记录每个地址获取 manifest 的延迟、拉取吞吐量和失败率 (指数滑动平均),
+    持久化到数据目录, 并在后台定期重新探测。
+    """
+
+    PROBE_REPOSITORY = "library/hello-world"
+    MANIFEST_TYPES = ", ".join([
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.oci.image.manifest.v1+json",
+    ])
+
+    def __init__(
+        self, db_path: Optional[pathlib.Path] = None, alpha: float = 0.3,
+        probe_timeout: float = 10, probe_interval: float = 600,
+    ) -> None:
+        self.db_file = db_path or utils.data_path("flick").joinpath("mirror_scores.json")
+        self.alpha = alpha
+        self.probe_timeout = probe_timeout
+        self.probe_interval = probe_interval
+        self._scores: Optional[Dict[str, MirrorScore]] = None
+        self._task: Optional[asyncio.Task] = None
+        # 每次探测和拉取都会更新评分, 合并后在线程池中写入
+        self._saver = storage.TableSaver(
+            self.db_file, "mirrors",
+            lambda: [dataclasses.asdict(score) for score in self.scores.values()],
+        )
+
+    @property
+    def scores(self) -> Dict[str, MirrorScore]:
+        if self._scores is None:
+            self._scores = {}
+            if not self.db_file.exists():
+                return self._scores
+            try:
+                with tinydb.TinyDB(self.db_file) as db:
+                    for doc in db.table("mirrors").all():
+                        score = MirrorScore(**doc)
+                        self._scores[score.host] = score
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("load mirror scores failed: {}", e)
+        return self._scores
+
+    def get(self, host: str) -> MirrorScore:
+        if host not in self.scores:
+            self.scores[host] = MirrorScore(host=host)
+        return self.scores[host]
+
+    def rank(self, hosts: List[str]) -> List[MirrorScore]:
+        return sorted((self.get(host) for host in dict.fromkeys(hosts)), key=MirrorScore.cost)
+
+    def _average(self, old: Optional[float], value: float) -> float:
+        return value if old is None else old + self.alpha * (value - old)
+
+    def record_probe(self, host: str, latency: Optional[float]):
+        score = self.get(host)
+        score.probes += 1
+        score.failure_rate = self._average(score.failure_rate, 0 if latency is not None else 1)
+        if latency is not None:
+            score.latency = self._average(score.latency, latency)
+        score.updated_at = time.time()
+        self.save(score)
+
+    def record_pull(
+        self, host: str, success: Optional[bool], size: int = 0, elapsed: float = 0
+    ):
+        """记录一次拉取, success 为 None 表示拉取被取消, 只记录吞吐量"""
+        score = self.get(host)
+        if success is not None:
+            score.pulls += 1
+            score.failure_rate = self._average(score.failure_rate, 0 if success else 1)
+        if size and elapsed > 0:
+            score.throughput = self._average(score.throughput, size / elapsed)
+        score.updated_at = time.time()
+        self.save(score)
+
+    def save(self, score: MirrorScore):
+        logger.debug("update mirror score {}", score)
+        self._saver.schedule()
+
+    async def probe(self, host: str, client: httpx.AsyncClient) -> Optional[float]:
+        """获取一次 manifest, 返回耗时, 失败时返回 None"""
+        url = f"https://{registry_host(host)}/v2/{self.PROBE_REPOSITORY}/manifests/latest"
+        headers = {"Accept": self.MANIFEST_TYPES}
+        started = time.monotonic()
+        try:
+            resp = await client.get(url, headers=headers)
+            if resp.status_code == 401:
+                token = await self._get_token(client, resp.headers.get("www-authenticate", ""))
+                headers["Authorization"] = f"Bearer {token}"
+                resp = await client.get(url, headers=headers)
+            resp.raise_for_status()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.debug("probe mirror {} failed: {}", host, e)
+            self.record_probe(host, None)
+            return None
+        latency = time.monotonic() - started
+        self.record_probe(host, latency)
+        return latency
+
+    @staticmethod
+    async def _get_token(client: httpx.AsyncClient, authenticate: str) -> str:
+        scheme, _, values = authenticate.partition(" ")
+        if scheme.lower() != "bearer":
+            raise ValueError(f"unsupported auth {authenticate}")
+        params = dict(re.findall(r'(\w+)="([^"]*)"', values))
+        realm = params.pop("realm")
+        resp = await client.get(realm, params=params)
+        resp.raise_for_status()
+        data = resp.json()
+        return data.get("token") or data.get("access_token")
+
+    async def probe_all(self, hosts: List[str]):
+        async with httpx.AsyncClient(timeout=self.probe_timeout, follow_redirects=True) as client:
+            await asyncio.gather(*[self.probe(host, client) for host in dict.fromkeys(hosts)])
+        logger.info(
+            "mirror ranks: {}", ", ".join(f"{s.host}({s.cost():.2f})" for s in self.rank(hosts))
+        )
+
+    def start(self, hosts: List[str]):
+        """在后台定期探测所有地址"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._probe_loop(hosts))
+
+    async def _probe_loop(self, hosts: List[str]):
+        while True:
+            try:
+                await self.probe_all(hosts)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("probe mirrors failed")
+            await asyncio.sleep(self.probe_interval)
+
+
+def registry_host(host: str) -> str:
+    return DOCKER_HUB_REGISTRY if host == DOCKER_HUB else host
+
+
+class ImagePuller:
+    """从 Docker Hub 和镜像加速地址中评分最高的几个同时拉取镜像, 采用最先成功的结果
+
+    其余的拉取会被取消, 关闭连接后 daemon 会中止对应的拉取。
+    成功后镜像被重新打上原始的 tag, 加速地址的 tag 会被删除,
+    取消前已经完成的其他拉取留下的 tag 也会被删除。
+    """
+
+    def __init__(
+        self, api: docker_api.DockerAPI, mirrors: Optional[List[str]] = None,
+        parallel: int = 3, progress_interval: float = 0.5,
+        scoreboard: Optional[MirrorScoreboard] = None,
+    ) -> None:
+        self.api = api
+        self.mirrors = REGISTRY_MIRRORS if mirrors is None else mirrors
+        self.parallel = parallel
+        self.progress_interval = progress_interval
+        self.scoreboard = scoreboard or MirrorScoreboard()
 
     @property
-    def client(self) -> docker.DockerClient:
-        if self._client is None:
+    def hosts(self) -> List[str]:
+        return [DOCKER_HUB] + self.mirrors
+
+    def start_probe(self):
+        self.scoreboard.start(self.hosts)
+
+    def sources(
+        self, repository: str, mirrors: Optional[List[str]] = None, parallel: Optional[int] = None
+    ) -> Dict[str, str]:
+        """返回 {地址: 拉取时使用的镜像名}, 按评分排序并只保留前 parallel 个"""
+        if not is_docker_hub_image(repository):
+            return {repository.split("/")[0]: repository}
+        path = repository if "/" in repository else f"library/{repository}"
+        hosts = self.hosts if mirrors is None else [DOCKER_HUB] + mirrors
+        ranked = self.scoreboard.rank(hosts)[: parallel or self.parallel]
+        return {
+            score.host: repository if score.host == DOCKER_HUB else f"{score.host}/{path}"
+            for score in ranked
+        }
+
+    async def pull(
+        self,
+        image: str,
+        mirrors: Optional[List[str]] = None,
+        on_progress: Optional[Callable[[str, Dict[str, dict]], Any]] = None,
+        parallel: Optional[int] = None,
+    ) -> str:
+        """拉取镜像, 返回本地可用的镜像名"""
+        repository, tag = parse_image(image)
+        sources = self.sources(repository, mirrors=mirrors, parallel=parallel)
+        logger.info("pull image {} from {}", image, list(sources.values()))
+        tasks = {
+            asyncio.create_task(self._pull_one(host, source, tag, on_progress)): source
+            for host, source in sources.items()
+        }
+        errors = []
+        winner = None
+        try:
+            pending = set(tasks)
+            while pending and not winner:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        logger.warning("pull from {} failed: {}", tasks[task], task.exception())
+                        errors.append(f"{tasks[task]}: {task.exception()}")
+                    elif not winner:
+                        winner = tasks[task]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not winner:
+            raise exceptions.ImagePullFailed(image, "; ".join(errors))
+
+        logger.success("pulled image {} from {}", image, winner)
+        # 没有被采用但同样成功的来源, 不包括和原始名称相同的来源
+        others = [
+            source for task, source in tasks.items()
+            if not task.cancelled() and not task.exception()
+            and source not in (winner, repository)
+        ]
+        if tag.startswith("@"):
+            # digest 无法作为 tag, 保留来源的名称
+            await self._untag([f"{source}{tag}" for source in others])
+            return f"{winner}{tag}"
+        if winner != repository:
+            await self._retag(f"{winner}:{tag}", repository, tag)
+        await self._untag([f"{source}:{tag}" for source in others])
+        return f"{repository}:{tag}"
+
+    async def _retag(self, source: str, repository: str, tag: str):
+        await self.api.post(
+            self.api.url("/images/{}/tag", source), params={"repo": repository, "tag": tag}
+        )
+        await self.api.delete(self.api.url("/images/{}", source))
+
+    async def _untag(self, names: List[str]):
+        for name in names:
             try:
-                self._client = docker.from_env()
-            except (
-                docker.errors.DockerException,
-                requests.exceptions.ConnectionError,
-                urllib3.exceptions.ProtocolError,
-            ) as e:
-                raise exceptions.CreateDockerClientFailed(str(e))
-        return self._client
-
-    def system(self) -> dict:
-        info = self.client.info()
+                await self.api.delete(self.api.url("/images/{}", name))
+            except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+                logger.warning("remove image tag {} failed: {}", name, e)
+
+    async def _pull_one(self, host: str, source: str, tag: str, on_progress=None):
+        params = {"fromImage": source}
+        if tag.startswith("@"):
+            params["fromImage"] = f"{source}{tag}"
+        else:
+            params["tag"] = tag
+        layers: Dict[str, dict] = {}
+        reported_at = 0.0
+        started = time.monotonic()
+        try:
+            async with self.api.stream("POST", "/images/create", params=params) as resp:
+                async for progress in docker_api.iter_json(resp):
+                    if progress.get("error"):
+                        raise exceptions.ImagePullFailed(source, progress["error"])
+                    if not progress.get("id"):
+                        continue
+                    detail = progress.get("progressDetail") or {}
+                    layer = layers.setdefault(progress["id"], {"current": 0, "total": 0})
+                    layer["status"] = progress.get("status", "")
+                    if progress.get("status") == "Downloading":
+                        layer.update(current=detail.get("current", 0), total=detail.get("total", 0))
+                    if on_progress and time.monotonic() - reported_at >= self.progress_interval:
+                        reported_at = time.monotonic()
+                        await self._report(on_progress, source, layers)
+        except asyncio.CancelledError:
+            # 被取消的拉取也能反映该地址的吞吐量, 但不计入失败
+            self._record_pull(host, None, layers, started)
+            raise
+        except (exceptions.ImagePullFailed, exceptions.DockerConnectionFailed,
+                docker.errors.APIError):
+            self._record_pull(host, False, layers, started)
+            raise
+        self._record_pull(host, True, layers, started)
+        if on_progress and layers:
+            await self._report(on_progress, source, layers)
+
+    def _record_pull(self, host: str, success: Optional[bool], layers: Dict[str, dict], started):
+        size = sum(layer["current"] for layer in layers.values())
+        self.scoreboard.record_pull(host, success, size=size, elapsed=time.monotonic() - started)
+
+    @staticmethod
+    async def _report(on_progress, source, layers):
+        result = on_progress(source, {key: dict(value) for key, value in layers.items()})
+        if inspect.isawaitable(result):
+            await result
+
+
+class DockerManager:
+
+    def __init__(
+        self, api: Optional[docker_api.DockerAPI] = None, batch_concurrency: int = 10
+    ) -> None:
+        self.api = api or docker_api.DockerAPI()
+        self.batch_concurrency = batch_concurrency
+        self.watcher = EventWatcher(self.api)
+        self.states = ContainerStates()
+        self.inventory = Inventory(self)
+        self.puller = ImagePuller(self.api)
+        self.watcher.add_listener(self.states.on_event)
+        self.watcher.add_listener(self.inventory.on_event)
+        self.watcher.add_reconnect_listener(self.inventory.on_reconnect)
+
+    async def system(self) -> dict:
+        info = await self.api.get("/info")
         return {
             "version": info["ServerVersion"],
             "root_dir": info["DockerRootDir"],
@@ -111,113 +738,271 @@ class DockerManager:
             "containers": info["Containers"],
         }
 
-    def containers(self, all_status=False):
-        containers = self.client.containers.list(all=all_status)
-        return [Container.from_raw_object(container) for container in containers]
-
-    def _get_container(self, id_or_name: str) -> docker_containers.Container:
-        container = self.client.containers.get(id_or_name)
-        if not container:
-            raise exceptions.ContainerNotExists(id_or_name)
-        return container
+    async def containers(
+        self,
+        all_status=False,
+        refresh=False,
+        status: Optional[str] = None,
+        image: Optional[str] = None,
+        label: Optional[str] = None,
+        name: Optional[str] = None,
+    ) -> List[Container]:
+        """name 按前缀匹配, 指定 status 时忽略 all_status"""
+        containers: List[Container] = await self.inventory.list("containers", refresh=refresh)
+        return [
+            container
+            for container in containers
+            if (container.status == status if status else all_status or container.is_running())
+            and (not image or container.image == image or container.image.startswith(f"{image}:"))
+            and (not name or container.name.startswith(name))
+            and match_labels(container.labels, label)
+        ]
+
+    async def fetch_containers(self, concurrency=20) -> List[Container]:
+        """从 docker daemon 获取所有容器详情"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def inspect_container(container_id):
+            async with semaphore:
+                return await self.get_container(container_id)
+
+        items = await self.api.get("/containers/json", params={"all": True})
+        containers = await asyncio.gather(
+            *[inspect_container(item["Id"]) for item in items], return_exceptions=True
+        )
+        # 列表和详情之间被删除的容器会返回 NotFound
+        return [item for item in containers if isinstance(item, Container)]
 
-    def get_container(self, id_or_name: str):
-        return Container.from_raw_object(self._get_container(id_or_name))
+    async def get_container(self, id_or_name: str) -> Container:
+        attrs = await self.api.get(self.api.url("/containers/{}/json", id_or_name))
+        return Container.from_raw_object(attrs)
 
-    def run_container(
+    async def run_container(
         self,
         image,
         name=None,
         command=None,
         auto_remove=False,
-        detach: Literal[True] = True,
-    ):
-        self.client.containers.run(
-            image=image,
-            name=name,
-            command=command,
-            auto_remove=auto_remove,
-            detach=detach,
+        detach: Literal[True] = True,  # pylint: disable=unused-argument
+    ) -> Container:
+        if isinstance(command, str):
+            # 与 docker-py 一致, 字符串命令按 shell 规则拆分为参数列表
+            command = shlex.split(command)
+        body = {"Image": image, "Cmd": command, "HostConfig": {"AutoRemove": auto_remove}}
+        try:
+            created = await self.api.post("/containers/create", params={"name": name}, body=body)
+        except docker.errors.NotFound:
+            # 镜像不存在, 拉取后重新创建
+            await self.pull_image(image)
+            created = await self.api.post("/containers/create", params={"name": name}, body=body)
+        await self.api.post(self.api.url("/containers/{}/start", created["Id"]))
+        return await self.get_container(created["Id"])
+
+    async def pull_image(
+        self,
+        image: str,
+        mirrors: Optional[List[str]] = None,
+        on_progress: Optional[Callable[[str, Dict[str, dict]], Any]] = None,
+        parallel: Optional[int] = None,
+    ) -> Image:
+        local_name = await self.puller.pull(
+            image, mirrors=mirrors, on_progress=on_progress, parallel=parallel
         )
+        return await self.get_image(local_name)
 
-    def rm_container(self, id_or_name: str, force=False):
-        container = self._get_container(id_or_name)
-        container.remove(force=force)
+    async def rm_container(self, id_or_name: str, force=False):
+        await self.api.delete(self.api.url("/containers/{}", id_or_name), params={"force": force})
 
-    def start_container(self, id_or_name: str, wait=False) -> Container:
-        container = self._get_container(id_or_name)
+    async def start_container(self, id_or_name: str) -> Container:
+        self.watcher.start()
         logger.info("start container {}", id_or_name)
-        container.start()
-        if not wait:
-            return Container.from_raw_object(container)
-        return self._wait_container_status(id_or_name, ["running", "active"])
+        await self.api.post(self.api.url("/containers/{}/start", id_or_name))
+        return await self._reload_container(id_or_name)
 
-    def stop_container(self, id_or_name: str, timeout=None, wait=False) -> Container:
-        container = self._get_container(id_or_name)
+    async def stop_container(self, id_or_name: str, timeout=None) -> Container:
+        self.watcher.start()
         logger.info("stop container {}", id_or_name)
-        container.stop(timeout=timeout)
-        if not wait:
-            return Container.from_raw_object(container)
-        return self._wait_container_status(id_or_name, ["exited", "stopped"])
-
-    def pause_container(self, id_or_name: str):
-        container = self._get_container(id_or_name)
-        container.pause()
-
-    def unpause_container(self, id_or_name: str):
-        container = self._get_container(id_or_name)
-        container.unpause()
+        # daemon 在容器停止后才返回, 最长等待 timeout 秒
+        await self.api.post(
+            self.api.url("/containers/{}/stop", id_or_name),
+            params={"t": timeout},
+            timeout=self.api.timeout + (timeout or 10),
+        )
+        return await self._reload_container(id_or_name)
+
+    async def restart_container(self, id_or_name: str, timeout=None) -> Container:
+        self.watcher.start()
+        logger.info("restart container {}", id_or_name)
+        await self.api.post(
+            self.api.url("/containers/{}/restart", id_or_name),
+            params={"t": timeout},
+            timeout=self.api.timeout + (timeout or 10),
+        )
+        return await self._reload_container(id_or_name)
+
+    async def container_action(
+        self, id_or_name: str, action: str, force=False, timeout=None
+    ) -> Optional[Container]:
+        """对容器执行 CONTAINER_ACTIONS 中的操作, 返回操作后的容器, 删除时返回 None"""
+        if action == "start":
+            return await self.start_container(id_or_name)
+        if action == "stop":
+            return await self.stop_container(id_or_name, timeout=timeout)
+        if action == "restart":
+            return await self.restart_container(id_or_name, timeout=timeout)
+        if action == "pause":
+            await self.pause_container(id_or_name)
+        elif action == "unpause":
+            await self.unpause_container(id_or_name)
+        elif action == "remove":
+            await self.rm_container(id_or_name, force=force)
+            return None
+        else:
+            raise ValueError(f"invalid container action {action}")
+        return await self.get_container(id_or_name)
+
+    async def batch_container_action(
+        self,
+        ids: List[str],
+        action: str,
+        concurrency: Optional[int] = None,
+        on_result: Optional[Callable[[str, Optional[Container], Optional[Exception]], Any]] = None,
+        force=False,
+        timeout=None,
+    ) -> Dict[str, Optional[str]]:
+        """并发地对多个容器执行同一操作, 同时进行的操作数不超过 concurrency
+
+        每个容器完成后调用 on_result(id, container, error), 返回 {id: 错误信息或 None}
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.batch_concurrency)
+        results: Dict[str, Optional[str]] = {}
+
+        async def run(id_or_name: str):
+            async with semaphore:
+                try:
+                    updated = await self.container_action(
+                        id_or_name, action, force=force, timeout=timeout
+                    )
+                except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+                    logger.error("{} container {} failed: {}", action, id_or_name, e)
+                    results[id_or_name] = str(e)
+                    updated, error = None, e
+                else:
+                    results[id_or_name] = None
+                    error = None
+            if on_result:
+                result = on_result(id_or_name, updated, error)
+                if inspect.isawaitable(result):
+                    await result
+
+        await asyncio.gather(*[run(id_or_name) for id_or_name in dict.fromkeys(ids)])
+        return results
+
+    async def _reload_container(self, id_or_name: str) -> Container:
+        container = await self.get_container(id_or_name)
+        self.states.update(container.id, container.status, only_unknown=True)
+        return container
 
-    def resize_container(self, id_or_name: str, height: int, width: int):
-        container = self._get_container(id_or_name)
-        container.resize(height, width)
+    async def pause_container(self, id_or_name: str):
+        await self.api.post(self.api.url("/containers/{}/pause", id_or_name))
 
-    def images(self, show_intermediate=False) -> List[Image]:
-        images = self.client.images.list(all=show_intermediate)
-        return [Image.from_raw_object(image) for image in images]
+    async def unpause_container(self, id_or_name: str):
+        await self.api.post(self.api.url("/containers/{}/unpause", id_or_name))
 
-    def get_image(self, image_id) -> Image:
-        image = self.client.images.get(image_id)
-        return Image.from_raw_object(image)
+    async def resize_container(self, id_or_name: str, height: int, width: int):
+        await self.api.post(
+            self.api.url("/containers/{}/resize", id_or_name), params={"h": height, "w": width}
+        )
 
-    def remove_image(self, id_or_tag: str, force=False):
+    async def images(
+        self,
+        show_intermediate=False,
+        refresh=False,
+        label: Optional[str] = None,
+        name: Optional[str] = None,
+    ) -> List[Image]:
+        """name 按前缀匹配镜像的任一 tag"""
+        if show_intermediate:
+            # 缓存中不包含中间层镜像
+            images = await self.fetch_images(show_intermediate=True)
+        else:
+            images = await self.inventory.list("images", refresh=refresh)
+        return [
+            image
+            for image in images
+            if (not name or any(tag.startswith(name) for tag in image.tags))
+            and match_labels(image.labels, label)
+        ]
+
+    async def fetch_images(self, show_intermediate=False) -> List[Image]:
+        items = await self.api.get("/images/json", params={"all": show_intermediate})
+        return [Image.from_raw_object(item) for item in items]
+
+    async def get_image(self, image_id) -> Image:
+        attrs = await self.api.get(self.api.url("/images/{}/json", image_id))
+        return Image.from_raw_object(attrs)
+
+    async def remove_image(self, id_or_tag: str, force=False):
         logger.info("remove image {}", id_or_tag)
-        self.client.images.remove(id_or_tag, force=force)
+        await self.api.delete(self.api.url("/images/{}", id_or_tag), params={"force": force})
 
-    def add_image_tag(self, image_id: str, repository: str, tag: Optional[str] = None) -> List[str]:
+    async def add_image_tag(
+        self, image_id: str, repository: str, tag: Optional[str] = None
+    ) -> List[str]:
         logger.info("image {} add tag: {}:{}", image_id, repository, tag)
-        image = self.client.images.get(image_id)
-        image.tag(repository, tag or "latest")
-        return image.tags
+        await self.api.post(
+            self.api.url("/images/{}/tag", image_id),
+            params={"repo": repository, "tag": tag or "latest"},
+        )
+        return (await self.get_image(image_id)).tags
+
+    def mirror_scores(self) -> List[MirrorScore]:
+        return self.puller.scoreboard.rank(self.puller.hosts)
+
+    async def probe_mirrors(self) -> List[MirrorScore]:
+        await self.puller.scoreboard.probe_all(self.puller.hosts)
+        return self.mirror_scores()
+
+    async def prune_images(self):
+        await self.api.post("/images/prune")
 
-    def prune_images(self):
-        self.client.images.prune()
+    async def volumes(
+        self, refresh=False, label: Optional[str] = None, name: Optional[str] = None
+    ) -> List[Volume]:
+        volumes: List[Volume] = await self.inventory.list("volumes", refresh=refresh)
+        return [
+            volume
+            for volume in volumes
+            if (not name or volume.name.startswith(name)) and match_labels(volume.labels, label)
+        ]
 
-    def volumes(self) -> List[Volume]:
-        items = self.client.volumes.list()
-        return [Volume.from_raw_object(volume) for volume in items]
+    async def fetch_volumes(self) -> List[Volume]:
+        result = await self.api.get("/volumes")
+        return [Volume.from_raw_object(item) for item in result.get("Volumes") or []]
 
-    def get_volume(self, volume_id) -> Volume:
-        volume = self.client.volumes.get(volume_id)
-        return Volume.from_raw_object(volume)
+    async def get_volume(self, volume_id) -> Volume:
+        attrs = await self.api.get(self.api.url("/volumes/{}", volume_id))
+        return Volume.from_raw_object(attrs)
 
-    def create_volume(
+    async def create_volume(
         self, name=None, driver=None, label: Optional[dict[str, str]] = None
     ) -> Volume:
-        volume = self.client.volumes.create(name=name, driver=driver, label=label)
-        return Volume.from_raw_object(volume)
-
-    def rm_volume(self, volume_id, force=False):
-        volume = self.client.volumes.get(volume_id)
-        volume.remove(force=force)
-
-    @retry(exceptions.ContainerStatusNotMatch, tries=60, delay=1)
-    def _wait_container_status(self, id_or_name, expect: List[str]) -> Container:
-        new_container = self.get_container(id_or_name)
-        logger.info("container {} status is {}", id_or_name, new_container.status)
-        if new_container.status in expect:
-            return new_container
-        raise exceptions.ContainerStatusNotMatch(id_or_name, new_container.status, expect)
+        body = {"Name": name, "Driver": driver or "local", "Labels": label or {}}
+        attrs = await self.api.post("/volumes/create", body=body)
+        return Volume.from_raw_object(attrs)
+
+    async def rm_volume(self, volume_id, force=False):
+        await self.api.delete(self.api.url("/volumes/{}", volume_id), params={"force": force})
+
+    async def wait_container_status(
+        self, current: Container, expect: List[str], timeout: float = 60
+    ) -> Container:
+        """等待容器状态变为 expect 中的任一状态, 由 docker 事件唤醒"""
+        status = await self.states.wait(current.id, expect, timeout=timeout)
+        logger.info("container {} status is {}", current.short_id, status)
+        if status == "removed":
+            raise exceptions.ContainerNotExists(current.short_id)
+        return dataclasses.replace(current, status=status)
 
 
 SERVICE = DockerManager()
@@ -0,0 +1,224 @@
+import asyncio
+import collections
+import dataclasses
+import re
+import struct
+import time
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import docker.errors
+import httpx
+from loguru import logger
+
+from . import container, exceptions
+
+STREAM_TYPES = {0: "stdin", 1: "stdout", 2: "stderr"}
+
+
+@dataclasses.dataclass
+class LogLine:
+    seq: int
+    stream: str
+    time: str
+    text: str
+
+    def to_json(self) -> dict:
+        return {"stream": self.stream, "time": self.time, "text": self.text}
+
+
+class LogDecoder:
+    """解析 docker 日志流
+
+    非 TTY 容器的日志为多路复用格式 (8 字节头 + 数据), TTY 容器为原始输出。
+    输出按行切分, 不完整的行会保留到下一次解析。
+    """
+
+    def __init__(self, tty: bool, max_line: int = 16 * 1024) -> None:
+        self.tty = tty
+        self.max_line = max_line
+        self._buffer = b""
+        self._partial: Dict[str, bytes] = {}
+
+    def feed(self, data: bytes) -> List[Tuple[str, str, str]]:
+        """返回 [(stream, time, text)]"""
+        if self.tty:
+            return self._split("stdout", data)
+        self._buffer += data
+        lines = []
+        while len(self._buffer) >= 8:
+            stream_type, size = struct.unpack(">BxxxL", self._buffer[:8])
+            if len(self._buffer) < 8 + size:
+                break
+            payload, self._buffer = self._buffer[8:8 + size], self._buffer[8 + size:]
+            lines.extend(self._split(STREAM_TYPES.get(stream_type, "stdout"), payload))
+        return lines
+
+    def flush(self) -> List[Tuple[str, str, str]]:
+        """返回缓存中不完整的行"""
+        lines = []
+        for stream in list(self._partial):
+            lines.extend(self._split(stream, b"\n"))
+        return lines
+
+    def _split(self, stream: str, data: bytes) -> List[Tuple[str, str, str]]:
+        data = self._partial.pop(stream, b"") + data
+        *lines, rest = data.split(b"\n")
+        if rest:
+            self._partial[stream] = rest[-self.max_line:]
+        result = []
+        for line in lines:
+            timestamp, _, text = line[: self.max_line].decode(errors="replace").partition(" ")
+            result.append((stream, timestamp, text.rstrip("\r")))
+        return result
+
+
+class LogFollower:
+    """一个容器共享的日志流
+
+    所有查看者共用一个上游连接, 最近的日志保存在固定大小的环形缓冲区中,
+    每个查看者按自己的序号读取, 落后超过缓冲区的部分会被丢弃。
+    """
+
+    def __init__(
+        self, manager: container.DockerManager, container_id: str, tty: bool,
+        buffer_size: int = 2000,
+    ) -> None:
+        self.manager = manager
+        self.container_id = container_id
+        self.tty = tty
+        self.lines: Deque[LogLine] = collections.deque(maxlen=buffer_size)
+        self.seq = 0
+        self.viewers = 0
+        self.closed = False
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        decoder = LogDecoder(self.tty)
+        params = {
+            "follow": True, "stdout": True, "stderr": True, "timestamps": True,
+            "since": int(time.time()),
+        }
+        path = self.manager.api.url("/containers/{}/logs", self.container_id)
+        try:
+            async with self.manager.api.stream("GET", path, params=params) as resp:
+                async for data in resp.aiter_bytes():
+                    await self._append(decoder.feed(data))
+        except (exceptions.DockerConnectionFailed, docker.errors.APIError, httpx.HTTPError) as e:
+            logger.warning("logs stream of {} closed: {}", self.container_id[:12], e)
+        finally:
+            self.closed = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _append(self, lines: List[Tuple[str, str, str]]):
+        if not lines:
+            return
+        for stream, timestamp, text in lines:
+            self.seq += 1
+            self.lines.append(LogLine(self.seq, stream, timestamp, text))
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def read(self, after: int, limit: int = 500) -> Tuple[List[LogLine], int]:
+        """读取序号大于 after 的日志, 返回 (日志, 被丢弃的行数)"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.seq > after or self.closed)
+        first = self.lines[0].seq if self.lines else self.seq + 1
+        dropped = max(first - after - 1, 0)
+        start = max(after + 1 - first, 0)
+        return [self.lines[i] for i in range(start, min(start + limit, len(self.lines)))], dropped
+
+
+class LogService:
+
+    def __init__(self, manager: container.DockerManager, buffer_size: int = 2000) -> None:
+        self.manager = manager
+        self.buffer_size = buffer_size
+        self.followers: Dict[str, LogFollower] = {}
+
+    def _open(self, container_id: str, tty: bool) -> LogFollower:
+        follower = self.followers.get(container_id)
+        if not follower or follower.closed:
+            follower = LogFollower(
+                self.manager, container_id, tty, buffer_size=self.buffer_size
+            )
+            follower.start()
+            self.followers[container_id] = follower
+        follower.viewers += 1
+        return follower
+
+    def _close(self, follower: LogFollower):
+        follower.viewers -= 1
+        if follower.viewers <= 0:
+            follower.stop()
+            if self.followers.get(follower.container_id) is follower:
+                self.followers.pop(follower.container_id)
+
+    async def history(
+        self, container_id: str, tty: bool, tail: int, since: Optional[int] = None
+    ) -> List[Tuple[str, str, str]]:
+        params = {
+            "stdout": True, "stderr": True, "timestamps": True, "tail": tail, "since": since,
+        }
+        content = await self.manager.api.get_content(
+            self.manager.api.url("/containers/{}/logs", container_id), params=params
+        )
+        decoder = LogDecoder(tty)
+        return decoder.feed(content) + decoder.flush()
+
+    async def follow(
+        self,
+        id_or_name: str,
+        tail: int = 100,
+        since: Optional[int] = None,
+        pattern: Optional[re.Pattern] = None,
+        batch: int = 500,
+    ) -> AsyncIterator[Tuple[List[dict], int]]:
+        """先返回历史日志, 再持续返回新日志, 每次产出 (日志, 被丢弃的行数)
+
+        pattern 用于在服务端过滤日志内容。
+        """
+        attrs = await self.manager.api.get(self.manager.api.url("/containers/{}/json", id_or_name))
+        container_id, tty = attrs["Id"], bool((attrs.get("Config") or {}).get("Tty"))
+
+        def matched(text: str) -> bool:
+            return not pattern or bool(pattern.search(text))
+
+        follower = self._open(container_id, tty)
+        try:
+            cursor = follower.seq
+            last_time = ""
+            if tail or since:
+                history = await self.history(container_id, tty, tail=tail, since=since)
+                if history:
+                    last_time = history[-1][1]
+                for i in range(0, len(history), batch):
+                    yield [
+                        {"stream": stream, "time": timestamp, "text": text}
+                        for stream, timestamp, text in history[i:i + batch]
+                        if matched(text)
+                    ], 0
+            while not (follower.closed and cursor >= follower.seq):
+                lines, dropped = await follower.read(cursor, limit=batch)
+                if lines:
+                    cursor = lines[-1].seq
+                elif dropped:
+                    cursor = follower.seq
+                yield [
+                    line.to_json() for line in lines
+                    # 与历史日志重叠的部分不再重复发送
+                    if line.time > last_time and matched(line.text)
+                ], dropped
+        finally:
+            self._close(follower)
+
+
+SERVICE = LogService(container.SERVICE)
@@ -0,0 +1,218 @@
+import asyncio
+import dataclasses
+import inspect
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import docker.errors
+from loguru import logger
+
+from . import container, docker_api, exceptions
+
+
+@dataclasses.dataclass
+class ContainerStats:
+    id: str
+    name: str = ""
+    cpu: float = 0
+    mem: int = 0
+    mem_limit: int = 0
+    mem_percent: float = 0
+    # 以下为每秒速率 (bytes/s)
+    net_rx: float = 0
+    net_tx: float = 0
+    blk_read: float = 0
+    blk_write: float = 0
+    pids: int = 0
+    read_at: float = 0
+
+    def to_json(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+def _blkio_bytes(stats: dict) -> tuple:
+    read = write = 0
+    for entry in (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        op = (entry.get("op") or "").lower()
+        if op == "read":
+            read += entry.get("value", 0)
+        elif op == "write":
+            write += entry.get("value", 0)
+    return read, write
+
+
+def _net_bytes(stats: dict) -> tuple:
+    networks = (stats.get("networks") or {}).values()
+    return sum(n.get("rx_bytes", 0) for n in networks), sum(n.get("tx_bytes", 0) for n in networks)
+
+
+def _cpu_percent(stats: dict) -> float:
+    cpu, precpu = stats.get("cpu_stats") or {}, stats.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (
+        precpu.get("cpu_usage") or {}
+    ).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0
+    online = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or [1])
+    return round(cpu_delta / system_delta * online * 100, 2)
+
+
+def _memory(stats: dict) -> tuple:
+    memory = stats.get("memory_stats") or {}
+    details = memory.get("stats") or {}
+    # 与 docker stats 一致, 不计算页缓存 (cgroup v1: cache, v2: inactive_file)
+    cache = details.get("inactive_file", details.get("cache", 0))
+    return max(memory.get("usage", 0) - cache, 0), memory.get("limit", 0)
+
+
+class StatsCollector:
+    """容器资源统计
+
+    运行中的容器最多 max_streams 个保持 stats 流式连接, 其余的容器每次以 stream=false 轮询,
+    同时最多 poll_concurrency 个请求。在服务端计算 CPU/内存/网络/磁盘 IO,
+    并按固定间隔把所有容器的最新数据作为一帧推送给订阅者。没有订阅者时关闭所有连接。
+    统计使用独立的连接池, 容器再多也不会占满其他 docker 接口使用的连接。
+    """
+
+    def __init__(
+        self,
+        manager: container.DockerManager,
+        interval: float = 2,
+        max_streams: int = 64,
+        poll_concurrency: int = 8,
+    ) -> None:
+        self.manager = manager
+        self.interval = interval
+        self.max_streams = max_streams
+        self.api = docker_api.DockerAPI(
+            host=manager.api.host,
+            max_connections=max_streams + poll_concurrency,
+            max_keepalive_connections=poll_concurrency,
+        )
+        self._poll_limit = asyncio.Semaphore(poll_concurrency)
+        self._streams: Dict[str, asyncio.Task] = {}
+        self._polls: Dict[str, asyncio.Task] = {}
+        self._latest: Dict[str, ContainerStats] = {}
+        self._previous: Dict[str, tuple] = {}
+        self._subscribers: Dict[str, Callable[[List[dict]], Any]] = {}
+        self._expires: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, key: str, callback: Callable[[List[dict]], Any], lease: float = 300):
+        """订阅 lease 秒, 到期前需要重新订阅"""
+        logger.info("subscribe container stats: {}", key)
+        self._subscribers[key] = callback
+        self._expires[key] = time.monotonic() + lease
+        if not self._task or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unsubscribe(self, key: str):
+        logger.info("unsubscribe container stats: {}", key)
+        self._subscribers.pop(key, None)
+        self._expires.pop(key, None)
+
+    def snapshot(self) -> List[dict]:
+        return [stats.to_json() for stats in self._latest.values()]
+
+    async def _run(self):
+        try:
+            while self._subscribers:
+                for key, expires in list(self._expires.items()):
+                    if expires < time.monotonic():
+                        self.unsubscribe(key)
+                try:
+                    await self._sync_streams()
+                except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+                    logger.warning("list running containers failed: {}", e)
+                frame = self.snapshot()
+                for key, callback in list(self._subscribers.items()):
+                    try:
+                        result = callback(frame)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:  # pylint: disable=broad-exception-caught
+                        logger.exception("publish container stats to {} failed", key)
+                await asyncio.sleep(self.interval)
+        finally:
+            for task in list(self._streams.values()) + list(self._polls.values()):
+                task.cancel()
+            self._streams.clear()
+            self._polls.clear()
+            self._latest.clear()
+            self._previous.clear()
+
+    async def _sync_streams(self):
+        running = {item.id: item for item in await self.manager.containers()}
+        for container_id in list(self._streams):
+            if container_id not in running or self._streams[container_id].done():
+                self._streams.pop(container_id).cancel()
+                self._latest.pop(container_id, None)
+                self._previous.pop(container_id, None)
+        for container_id in list(self._polls):
+            if container_id not in running:
+                self._polls.pop(container_id).cancel()
+                self._latest.pop(container_id, None)
+                self._previous.pop(container_id, None)
+        for container_id, item in running.items():
+            if container_id in self._streams:
+                continue
+            if len(self._streams) < self.max_streams:
+                poll = self._polls.pop(container_id, None)
+                if poll:
+                    poll.cancel()
+                self._streams[container_id] = asyncio.create_task(
+                    self._follow(container_id, item.name)
+                )
+            elif container_id not in self._polls or self._polls[container_id].done():
+                self._polls[container_id] = asyncio.create_task(
+                    self._poll(container_id, item.name)
+                )
+
+    async def _follow(self, container_id: str, name: str):
+        path = self.api.url("/containers/{}/stats", container_id)
+        try:
+            async with self.api.stream("GET", path, params={"stream": True}) as resp:
+                async for stats in docker_api.iter_json(resp):
+                    self._update(container_id, name, stats)
+        except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+            logger.debug("stats stream of {} closed: {}", container_id[:12], e)
+
+    async def _poll(self, container_id: str, name: str):
+        path = self.api.url("/containers/{}/stats", container_id)
+        try:
+            async with self._poll_limit:
+                stats = await self.api.get(path, params={"stream": False})
+        except (exceptions.DockerConnectionFailed, docker.errors.APIError) as e:
+            logger.debug("poll stats of {} failed: {}", container_id[:12], e)
+            return
+        self._update(container_id, name, stats)
+
+    def _update(self, container_id: str, name: str, stats: dict):
+        now = time.monotonic()
+        counters = _net_bytes(stats) + _blkio_bytes(stats)
+        rates = [0.0] * len(counters)
+        if container_id in self._previous:
+            last_at, last = self._previous[container_id]
+            elapsed = now - last_at
+            if elapsed > 0:
+                rates = [max(new - old, 0) / elapsed for new, old in zip(counters, last)]
+        self._previous[container_id] = (now, counters)
+        mem, mem_limit = _memory(stats)
+        self._latest[container_id] = ContainerStats(
+            id=container_id[:12],
+            name=name,
+            cpu=_cpu_percent(stats),
+            mem=mem,
+            mem_limit=mem_limit,
+            mem_percent=round(mem / mem_limit * 100, 2) if mem_limit else 0,
+            net_rx=round(rates[0]),
+            net_tx=round(rates[1]),
+            blk_read=round(rates[2]),
+            blk_write=round(rates[3]),
+            pids=(stats.get("pids_stats") or {}).get("current", 0),
+            read_at=time.time(),
+        )
+
+
+SERVICE = StatsCollector(container.SERVICE)
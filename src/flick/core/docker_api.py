@@ -0,0 +1,212 @@
+import contextlib
+import json
+import os
+import ssl
+from typing import Any, AsyncIterator, Optional
+from urllib import parse
+
+import docker.errors
+import httpx
+from loguru import logger
+
+from . import exceptions
+
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+
+
+class DockerAPI:
+    """基于 httpx 的异步 docker engine API 客户端
+
+    通过 unix socket (或 tcp) 直接访问 docker daemon, 连接由连接池复用,
+    请求不会阻塞事件循环, 也不占用线程。
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        timeout: float = 60,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+    ) -> None:
+        self.host = host or os.getenv("DOCKER_HOST") or DEFAULT_DOCKER_HOST
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """第一次使用时创建, DOCKER_HOST 不受支持 (例如 ssh:// 或 npipe://) 时抛出
+        CreateDockerClientFailed"""
+        if self._client is None:
+            url = parse.urlparse(self.host)
+            if url.scheme == "unix":
+                transport = httpx.AsyncHTTPTransport(uds=url.path, limits=self.limits)
+                base_url = "http://docker"
+            elif url.scheme in ["tcp", "http", "https"]:
+                tls = self._tls_context(url.scheme == "https")
+                transport = httpx.AsyncHTTPTransport(verify=tls or False, limits=self.limits)
+                base_url = f"{'https' if tls else 'http'}://{url.netloc}"
+            else:
+                raise exceptions.CreateDockerClientFailed(
+                    f"unsupported docker host {self.host}, use unix://, tcp:// or https://"
+                )
+            self._client = httpx.AsyncClient(
+                transport=transport, base_url=base_url, timeout=self.timeout
+            )
+        return self._client
+
+    @staticmethod
+    def _tls_context(https: bool = False) -> Optional[ssl.SSLContext]:
+        """按 docker 命令行的约定使用 DOCKER_TLS_VERIFY 和 DOCKER_CERT_PATH
+
+        DOCKER_TLS_VERIFY 不为空时用 ca.pem 校验服务端, 只设置了 DOCKER_CERT_PATH 时不校验,
+        证书目录中有 cert.pem/key.pem 时作为客户端证书; 两个变量都没有设置时,
+        https:// 使用系统证书校验, 其他地址不使用 TLS, 返回 None。
+        """
+        verify = bool(os.getenv("DOCKER_TLS_VERIFY"))
+        env_cert_path = os.getenv("DOCKER_CERT_PATH")
+        if not (verify or env_cert_path or https):
+            return None
+        cert_path = env_cert_path or os.path.join(os.path.expanduser("~"), ".docker")
+        ca_file = os.path.join(cert_path, "ca.pem")
+        cert_file = os.path.join(cert_path, "cert.pem")
+        key_file = os.path.join(cert_path, "key.pem")
+        try:
+            if verify:
+                context = ssl.create_default_context(cafile=ca_file)
+            elif not env_cert_path:
+                context = ssl.create_default_context()
+            else:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if os.path.exists(cert_file) and os.path.exists(key_file):
+                context.load_cert_chain(cert_file, key_file)
+        except (OSError, ssl.SSLError) as e:
+            raise exceptions.CreateDockerClientFailed(
+                f"load docker tls certificates from {cert_path} failed: {e}"
+            ) from e
+        return context
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def url(template: str, *args: str) -> str:
+        return template.format(*[parse.quote(arg, safe="/:") for arg in args])
+
+    async def _send(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict] = None,
+        body: Any = None,
+        timeout: Any = httpx.USE_CLIENT_DEFAULT,
+    ) -> httpx.Response:
+        try:
+            resp = await self.client.request(
+                method, path, params=self._params(params), json=body, timeout=timeout
+            )
+        except httpx.TransportError as e:
+            raise exceptions.DockerConnectionFailed(str(e)) from e
+        self._raise_for_status(resp, await resp.aread())
+        return resp
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict] = None,
+        body: Any = None,
+        timeout: Any = httpx.USE_CLIENT_DEFAULT,
+    ) -> Any:
+        resp = await self._send(method, path, params=params, body=body, timeout=timeout)
+        if not resp.content:
+            return None
+        if resp.headers.get("content-type", "").startswith("application/json"):
+            return resp.json()
+        return resp.text
+
+    async def get(self, path: str, params: Optional[dict] = None) -> Any:
+        return await self.request("GET", path, params=params)
+
+    async def get_content(self, path: str, params: Optional[dict] = None) -> bytes:
+        """获取原始响应内容, 例如非流式的容器日志"""
+        return (await self._send("GET", path, params=params)).content
+
+    async def post(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        body: Any = None,
+        timeout: Any = httpx.USE_CLIENT_DEFAULT,
+    ) -> Any:
+        return await self.request("POST", path, params=params, body=body, timeout=timeout)
+
+    async def delete(self, path: str, params: Optional[dict] = None) -> Any:
+        return await self.request("DELETE", path, params=params)
+
+    @contextlib.asynccontextmanager
+    async def stream(
+        self, method: str, path: str, params: Optional[dict] = None, body: Any = None
+    ) -> AsyncIterator[httpx.Response]:
+        """打开一个流式响应 (events/stats/logs/pull), 读超时不受限制
+
+        退出上下文时连接会被关闭, daemon 随之终止对应的操作。
+        """
+        timeout = httpx.Timeout(self.timeout, read=None)
+        try:
+            async with self.client.stream(
+                method, path, params=self._params(params), json=body, timeout=timeout
+            ) as resp:
+                if resp.status_code >= 400:
+                    self._raise_for_status(resp, await resp.aread())
+                yield resp
+        except httpx.TransportError as e:
+            raise exceptions.DockerConnectionFailed(str(e)) from e
+
+    @staticmethod
+    def _params(params: Optional[dict]) -> Optional[dict]:
+        if not params:
+            return None
+        values = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = "1" if value else "0"
+            elif isinstance(value, dict):
+                value = json.dumps(value)
+            values[key] = value
+        return values
+
+    @staticmethod
+    def _raise_for_status(resp: httpx.Response, content: bytes):
+        if resp.status_code < 400:
+            return
+        try:
+            explanation = json.loads(content).get("message", "")
+        except ValueError:
+            explanation = content.decode(errors="replace")
+        message = f"{resp.status_code} Error for {resp.request.url}"
+        logger.debug("docker api error: {} {}", message, explanation)
+        if resp.status_code == 404:
+            raise docker.errors.NotFound(message, explanation=explanation)
+        raise docker.errors.APIError(message, explanation=explanation)
+
+
+async def iter_json(resp: httpx.Response) -> AsyncIterator[dict]:
+    """逐行解析 docker 返回的 JSON 流"""
+    async for line in resp.aiter_lines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logger.warning("invalid json line from docker: {}", line)
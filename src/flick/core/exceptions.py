@@ -9,6 +9,12 @@ class CreateDockerClientFailed(Exception):
         super().__init__(f"create docker client failed: {reason}")
 
 
+class DockerConnectionFailed(Exception):
+
+    def __init__(self, reason) -> None:
+        super().__init__(f"connect to docker failed: {reason}")
+
+
 class ContainerNotExists(Exception):
 
     def __init__(self, id_or_name) -> None:
@@ -25,3 +31,21 @@ class ContainerStatusNotMatch(Exception):
 
     def __init__(self, id_or_name:str, actual: str, expect: List[str]) -> None:
         super().__init__(f"container {id_or_name} status is {actual}, expect {expect}")
+
+
+class ImagePullFailed(Exception):
+
+    def __init__(self, image: str, reason: str) -> None:
+        super().__init__(f"pull image {image} failed: {reason}")
+
+
+class PackageIndexFailed(Exception):
+
+    def __init__(self, name: str, reason: str) -> None:
+        super().__init__(f"query package {name} from index failed: {reason}")
+
+
+class CommandCancelled(Exception):
+
+    def __init__(self, job_id: str) -> None:
+        super().__init__(f"command {job_id} cancelled")
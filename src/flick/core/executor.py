@@ -1,21 +1,201 @@
+import asyncio
+import codecs
+import collections
+import dataclasses
+import inspect
+import re
+import shlex
 import subprocess
+import time
+import uuid
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
 
 from loguru import logger
 
+from flick.core import exceptions
+
+LINE_SEPARATOR = re.compile(r"\r\n|\r|\n")
+
+
+def new_job_id() -> str:
+    return f"job-{uuid.uuid4().hex[:12]}"
+
+
+class OutputBuffer:
+    """保存命令输出的最后 limit 个字符"""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.lines: Deque[str] = collections.deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        while self.size > self.limit and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft()) + 1
+            self.truncated = True
+
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+
+@dataclasses.dataclass
+class Job:
+    id: str
+    argv: List[str]
+    started_at: float
+    process: Optional[asyncio.subprocess.Process] = None
+    cancelled: bool = False
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "argv": self.argv,
+            "started_at": self.started_at,
+            "pid": self.process.pid if self.process else None,
+        }
+
 
 class Executor:
+    """执行外部命令, 参数以 argv 列表传递, 不经过 shell"""
+
+    # 正在运行的异步命令, 用于查询和取消
+    jobs: Dict[str, Job] = {}
+
+    def __init__(self, cmd: Union[str, List[str]]) -> None:
+        self.argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
+    def execute(self, *args, timeout: Optional[float] = None) -> Tuple[int, str]:
+        """同步执行命令, 返回 (退出码, 合并的 stdout/stderr)"""
+        argv = self.argv + list(args)
+        logger.debug("RUN: {}", shlex.join(argv))
+        try:
+            result = subprocess.run(
+                argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                timeout=timeout, check=False,
+            )
+        except subprocess.TimeoutExpired:
+            logger.warning("command timed out after {}s: {}", timeout, shlex.join(argv))
+            raise
+        output = result.stdout.rstrip("\n")
+        logger.debug("Return: [{}]", result.returncode)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, argv, output=output)
+        return result.returncode, output
 
-    def __init__(self, cmd) -> None:
-        self.cmd = cmd
+    async def run(
+        self,
+        *args,
+        on_line: Optional[Callable[[str, str], Any]] = None,
+        timeout: Optional[float] = None,
+        max_output: int = 1024 * 1024,
+        job_id: Optional[str] = None,
+    ) -> Tuple[int, str]:
+        """异步执行命令, 每输出一行调用 on_line(stream, line)
 
-    def execute(self, *args):
-        cmd = [self.cmd]
-        cmd.extend(args)
-        logger.debug("RUN: {}", " ".join(cmd))
-        status, output = subprocess.getstatusoutput(
-            " ".join(cmd),
+        超时抛出 subprocess.TimeoutExpired, 被取消时抛出 CommandCancelled,
+        退出码非 0 时抛出 subprocess.CalledProcessError。
+        返回的输出只保留最后 max_output 个字符。
+        """
+        argv = self.argv + list(args)
+        job = Job(id=job_id or new_job_id(), argv=argv, started_at=time.time())
+        logger.debug("RUN [{}]: {}", job.id, shlex.join(argv))
+        output = OutputBuffer(max_output)
+        job.process = await asyncio.create_subprocess_exec(
+            *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
         )
-        logger.debug("Return: [{}]", status)
-        if status != 0:
-            raise subprocess.CalledProcessError(status, output)
-        return status, output
+        self.jobs[job.id] = job
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self._read(job.process.stdout, "stdout", output, on_line),
+                    self._read(job.process.stderr, "stderr", output, on_line),
+                    job.process.wait(),
+                ),
+                timeout=timeout,
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            await self._terminate(job.process)
+            if job.cancelled:
+                raise exceptions.CommandCancelled(job.id) from e
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning("command {} timed out after {}s", job.id, timeout)
+                raise subprocess.TimeoutExpired(argv, timeout, output=output.text()) from e
+            raise
+        finally:
+            self.jobs.pop(job.id, None)
+        logger.debug("Return [{}]: [{}]", job.id, job.process.returncode)
+        if job.cancelled:
+            raise exceptions.CommandCancelled(job.id)
+        if output.truncated:
+            logger.debug("output of {} truncated to {} chars", job.id, max_output)
+        if job.process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                job.process.returncode, argv, output=output.text()
+            )
+        return job.process.returncode, output.text()
+
+    @staticmethod
+    async def _read(
+        stream: asyncio.StreamReader,
+        name: str,
+        output: OutputBuffer,
+        on_line: Optional[Callable[[str, str], Any]],
+    ):
+        # 按块读取并同时按 \r 和 \n 分行, 进度条等不换行的输出也能及时推送
+        # 多字节字符可能被分在两个块中, 使用增量解码器保留不完整的字节
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+        while True:
+            chunk = await stream.read(4096)
+            *lines, pending = LINE_SEPARATOR.split(
+                pending + decoder.decode(chunk, final=not chunk)
+            )
+            for line in lines:
+                if not line:
+                    continue
+                output.append(line)
+                if on_line:
+                    result = on_line(name, line)
+                    if inspect.isawaitable(result):
+                        await result
+            if not chunk:
+                break
+        if pending:
+            output.append(pending)
+            if on_line:
+                result = on_line(name, pending)
+                if inspect.isawaitable(result):
+                    await result
+
+    @staticmethod
+    async def _terminate(process: asyncio.subprocess.Process, grace: float = 5):
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=grace)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    @classmethod
+    def cancel(cls, job_id: str) -> bool:
+        """取消正在运行的命令, 命令不存在时返回 False"""
+        job = cls.jobs.get(job_id)
+        if not job or not job.process or job.process.returncode is not None:
+            return False
+        logger.info("cancel command {}", job_id)
+        job.cancelled = True
+        process = job.process
+        process.terminate()
+
+        def kill():
+            if process.returncode is None:
+                process.kill()
+
+        asyncio.get_running_loop().call_later(5, kill)
+        return True
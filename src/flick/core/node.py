@@ -1,9 +1,20 @@
+import array
+import bisect
 import dataclasses
+import functools
+import math
 import platform
-from typing import Dict, List, Optional
+import threading
+import time
+import zlib
+from concurrent import futures
+from typing import Dict, List, Optional, Tuple
 
 import distro
 import psutil
+from loguru import logger
+
+MOUNTINFO = "/proc/self/mountinfo"
 
 
 @dataclasses.dataclass
@@ -23,6 +34,8 @@ class Disk:
     fstype: str
     opts: str = ""
     usage: Optional[DiskUsage] = None
+    # 读取使用率超时或失败时为 unavailable
+    status: str = "ok"
 
     def to_dict(self):
         return dataclasses.asdict(self)
@@ -36,12 +49,338 @@ class NetInterface:
     bytes_recv: int = 0
     packets_sent: int = 0
     packets_recv: int = 0
+    # 最近一次采集的每秒速率 (bytes/s)
+    rx_rate: float = 0
+    tx_rate: float = 0
 
     def to_dict(self):
         return dataclasses.asdict(self)
 
+class RingBuffer:
+    """固定大小的环形缓冲区, 数据保存在 array 中"""
+
+    def __init__(self, size: int, typecode: str = "f") -> None:
+        self.size = size
+        self._data = array.array(typecode, [0] * size)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return min(self._count, self.size)
+
+    def append(self, value: float):
+        self._data[self._count % self.size] = value
+        self._count += 1
+
+    def latest(self) -> Optional[float]:
+        return self._data[(self._count - 1) % self.size] if self._count else None
+
+    def values(self, last: Optional[int] = None) -> List[float]:
+        """按时间顺序返回最近 last 个值"""
+        count = len(self) if last is None else min(last, len(self))
+        start = self._count - count
+        return [self._data[i % self.size] for i in range(start, self._count)]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """按最近秩法计算百分位数"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def _merge(points: List[tuple]) -> tuple:
+    """合并多个 (avg, min, max, p95) 数据点"""
+    return (
+        sum(point[0] for point in points) / len(points),
+        min(point[1] for point in points),
+        max(point[2] for point in points),
+        percentile([point[3] for point in points], 95),
+    )
+
+
+class Rollup:
+    """一种时间粒度的降采样数据, 每个点保存 avg/min/max/p95"""
+
+    def __init__(self, step: int, size: int) -> None:
+        self.step = step
+        self.size = size
+        self.timestamps = RingBuffer(size, "d")
+        self.avg = RingBuffer(size)
+        self.min = RingBuffer(size)
+        self.max = RingBuffer(size)
+        self.p95 = RingBuffer(size)
+
+    def append(self, timestamp: float, point: tuple):
+        self.timestamps.append(timestamp)
+        for buffer, value in zip([self.avg, self.min, self.max, self.p95], point):
+            buffer.append(value)
+
+    def points(self, since: float) -> List[tuple]:
+        """返回 since 之后的数据点 [(timestamp, avg, min, max, p95)]"""
+        timestamps = self.timestamps.values()
+        start = bisect.bisect_left(timestamps, since)
+        count = len(timestamps) - start
+        return list(zip(
+            timestamps[start:],
+            *[buffer.values(count) for buffer in [self.avg, self.min, self.max, self.p95]],
+        ))
+
+
+class Series:
+    """一个指标的时间序列
+
+    原始数据按采集间隔保存 RAW_SIZE 个点, 并逐级降采样为分钟和小时数据,
+    每一级都是固定大小的环形缓冲区, 占用内存与运行时间无关。
+    """
+
+    RAW_SIZE = 3600
+    ROLLUPS = ((60, 1440), (3600, 720))
+
+    def __init__(self) -> None:
+        self.timestamps = RingBuffer(self.RAW_SIZE, "d")
+        self.values = RingBuffer(self.RAW_SIZE)
+        self.rollups = [Rollup(step, size) for step, size in self.ROLLUPS]
+        # 每一级正在累积的时间段及其数据点
+        self._buckets: List[float] = [0] * len(self.rollups)
+        self._pending: List[List[tuple]] = [[] for _ in self.rollups]
+        self.updated_at = 0.0
+
+    def add(self, timestamp: float, value: float):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        self.updated_at = timestamp
+        self._roll(0, timestamp, (value, value, value, value))
+
+    def _roll(self, level: int, timestamp: float, point: tuple):
+        if level >= len(self.rollups):
+            return
+        rollup = self.rollups[level]
+        bucket = timestamp // rollup.step * rollup.step
+        pending = self._pending[level]
+        if pending and bucket != self._buckets[level]:
+            merged = _merge(pending)
+            rollup.append(self._buckets[level], merged)
+            self._pending[level] = pending = []
+            self._roll(level + 1, self._buckets[level], merged)
+        self._buckets[level] = bucket
+        pending.append(point)
+
+    def raw(self, since: float) -> List[tuple]:
+        timestamps = self.timestamps.values()
+        start = bisect.bisect_left(timestamps, since)
+        return list(zip(timestamps[start:], self.values.values(len(timestamps) - start)))
+
+    def rolled(self, level: int, since: float) -> List[tuple]:
+        """返回降采样数据, 包括尚未结束的时间段"""
+        points = self.rollups[level].points(since)
+        if self._pending[level] and self._buckets[level] >= since:
+            points.append((self._buckets[level], *_merge(self._pending[level])))
+        return points
+
+
+class MetricsStore:
+    """节点指标的时间序列存储
+
+    查询时按 step 选择原始数据 (1s) 或分钟/小时降采样数据,
+    长时间未更新的指标 (例如已删除的网卡) 会被清理, 指标总数不超过 max_series。
+    """
+
+    def __init__(self, max_series: int = 512, idle: float = 3600) -> None:
+        self.max_series = max_series
+        self.idle = idle
+        self.series: Dict[str, Series] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def steps(self) -> List[int]:
+        return [1] + [step for step, _ in Series.ROLLUPS]
+
+    def add(self, timestamp: float, values: Dict[str, float]):
+        with self._lock:
+            for name, value in values.items():
+                series = self.series.get(name)
+                if series is None:
+                    if len(self.series) >= self.max_series:
+                        logger.warning("too many metrics, drop {}", name)
+                        continue
+                    series = self.series[name] = Series()
+                series.add(timestamp, value)
+
+    def prune(self, now: float):
+        with self._lock:
+            for name, series in list(self.series.items()):
+                if now - series.updated_at > self.idle:
+                    del self.series[name]
+
+    def latest(self, name: str) -> Optional[float]:
+        with self._lock:
+            series = self.series.get(name)
+            return series.values.latest() if series else None
+
+    def history(self, name: str, since: float) -> List[tuple]:
+        with self._lock:
+            series = self.series.get(name)
+            return series.raw(since) if series else []
+
+    def choose_step(self, since: float, step: Optional[int] = None) -> int:
+        """未指定 step 时选择能覆盖 since 的最小粒度, 否则选择不大于 step 的最大粒度"""
+        if step:
+            return max(s for s in self.steps if s <= step) if step >= 1 else 1
+        span = time.time() - since
+        for s, size in [(1, Series.RAW_SIZE), *Series.ROLLUPS]:
+            if span <= s * size:
+                return s
+        return self.steps[-1]
+
+    def query(
+        self, since: float, step: Optional[int] = None, names: Optional[List[str]] = None
+    ) -> dict:
+        """查询 since 之后的数据, names 为指标名称或前缀, 例如 net.eth0. 或 cpu.percent"""
+        step = self.choose_step(since, step)
+        result = {}
+        with self._lock:
+            for name, series in self.series.items():
+                if names and not any(name.startswith(prefix) for prefix in names):
+                    continue
+                if step == 1:
+                    points = series.raw(since)
+                    data = {
+                        "timestamps": [point[0] for point in points],
+                        "values": [round(point[1], 2) for point in points],
+                    }
+                    values = data["values"]
+                else:
+                    points = series.rolled(self.steps.index(step) - 1, since)
+                    data = {"timestamps": [point[0] for point in points]}
+                    for i, key in enumerate(["avg", "min", "max", "p95"], 1):
+                        data[key] = [round(point[i], 2) for point in points]
+                    values = data["avg"]
+                data["summary"] = {
+                    "avg": round(sum(values) / len(values), 2) if values else 0,
+                    "min": min(values, default=0),
+                    "max": max(values, default=0),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "p99": percentile(values, 99),
+                }
+                result[name] = data
+        return {"since": since, "step": step, "series": result}
+
+
+class MetricsCollector:
+    """后台定时采集节点指标并写入 MetricsStore
+
+    网络和磁盘 IO 的字节计数转换为每秒速率保存, 分区使用率变化较慢,
+    每 partition_interval 秒采集一次。
+    """
+
+    def __init__(
+        self, manager: "NodeManager", interval: float = 1, partition_interval: float = 60
+    ) -> None:
+        self.manager = manager
+        self.interval = interval
+        self.partition_interval = partition_interval
+        self.store = MetricsStore()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="node-metrics", daemon=True)
+            self._thread.start()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self):
+        last: Optional[tuple] = None
+        last_partitions = last_prune = 0.0
+        while True:
+            try:
+                # 在采集线程中阻塞 interval 秒
+                percents = psutil.cpu_percent(interval=self.interval, percpu=True)
+                now = time.time()
+                values = self._gauges(percents)
+                counters = self._counters()
+                if last:
+                    elapsed = now - last[0]
+                    for name, value in counters.items():
+                        if name in last[1] and elapsed > 0:
+                            values[name] = max(value - last[1][name], 0) / elapsed
+                last = (now, counters)
+                if now - last_partitions >= self.partition_interval:
+                    last_partitions = now
+                    for disk in self.manager.partitions():
+                        if disk.usage:
+                            values[f"partition.{disk.mountpoint}.percent"] = disk.usage.percent
+                self.store.add(now, values)
+                if now - last_prune >= 60:
+                    last_prune = now
+                    self.store.prune(now)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("collect node metrics failed")
+                time.sleep(self.interval)
+
+    @staticmethod
+    def _gauges(percents: List[float]) -> Dict[str, float]:
+        mem = psutil.virtual_memory()
+        values = {
+            "cpu.percent": sum(percents) / len(percents) if percents else 0,
+            "memory.percent": mem.percent,
+            "memory.used": mem.used,
+        }
+        for i, percent in enumerate(percents):
+            values[f"cpu.core{i}.percent"] = percent
+        return values
+
+    @staticmethod
+    def _counters() -> Dict[str, int]:
+        counters = {}
+        for interface, stats in psutil.net_io_counters(pernic=True).items():
+            if interface == "lo":
+                continue
+            counters[f"net.{interface}.rx"] = stats.bytes_recv
+            counters[f"net.{interface}.tx"] = stats.bytes_sent
+        disk = psutil.disk_io_counters()
+        if disk:
+            counters["disk.read"] = disk.read_bytes
+            counters["disk.write"] = disk.write_bytes
+        return counters
+
+
+def _mountinfo_signature() -> Optional[int]:
+    """挂载信息的校验值, 用于判断挂载点是否变化, 不支持时返回 None"""
+    try:
+        with open(MOUNTINFO, "rb") as f:
+            return zlib.crc32(f.read())
+    except OSError:
+        return None
+
+
 class NodeManager:
 
+    def __init__(
+        self,
+        metrics_interval: float = 1,
+        usage_timeout: float = 2,
+        usage_ttl: float = 5,
+    ) -> None:
+        self.metrics = MetricsCollector(self, interval=metrics_interval)
+        self.usage_timeout = usage_timeout
+        self.usage_ttl = usage_ttl
+        # mountpoint -> (读取时间, 使用率), 读取失败时使用率为 None
+        self._usage_cache: Dict[str, Tuple[float, Optional[DiskUsage]]] = {}
+        # mountpoint -> (提交时间, future), 卡住的挂载点不会重复提交
+        self._usage_pending: Dict[str, Tuple[float, futures.Future]] = {}
+        self._mounts: Dict[bool, list] = {}
+        self._mounts_signature: Optional[int] = None
+        # future 已完成时 add_done_callback 会在持有锁的线程中直接回调
+        self._lock = threading.RLock()
+
     def platform(self) -> dict:
         info = {
             "system": platform.system(),
@@ -59,12 +398,39 @@ class NodeManager:
         # info['boot_time'] = datetime.datetime.fromtimestamp(
         #        boot_time).strftime("%Y-%m-%d %H:%M:%S")
 
-    def cpu(self) -> dict:
-        return {
+    def cpu(self, history: Optional[float] = None) -> dict:
+        """返回最近一次采样的 CPU 使用率, history 为需要返回的历史数据的秒数"""
+        self.metrics.start()
+        store = self.metrics.store
+        count = psutil.cpu_count() or 1
+        info = {
             "count": psutil.cpu_count(logical=False),
-            "count_logical": psutil.cpu_count(),
-            "percent": psutil.cpu_percent(interval=1),
+            "count_logical": count,
         }
+        percent = store.latest("cpu.percent")
+        if percent is None:
+            # 采集线程刚启动, 与上一次调用比较, 不会阻塞
+            percents = psutil.cpu_percent(interval=None, percpu=True)
+            info["percent"] = round(sum(percents) / len(percents), 1) if percents else 0
+            info["per_cpu"] = percents
+        else:
+            info["percent"] = round(percent, 1)
+            info["per_cpu"] = [
+                round(store.latest(f"cpu.core{i}.percent") or 0, 1) for i in range(count)
+            ]
+        if history:
+            since = time.time() - history
+            total = store.history("cpu.percent", since)
+            info["history"] = {
+                "interval": self.metrics.interval,
+                "timestamps": [point[0] for point in total],
+                "percent": [round(point[1], 1) for point in total],
+                "per_cpu": [
+                    [round(point[1], 1) for point in store.history(f"cpu.core{i}.percent", since)]
+                    for i in range(count)
+                ],
+            }
+        return info
 
     def memory(self) -> dict:
         mem = psutil.virtual_memory()
@@ -87,21 +453,103 @@ class NodeManager:
     def partitions(self, all_device=False) -> List[Disk]:
         """获取所有磁盘分区信息
 
-        如果 all_device=False, 仅物理设备
+        如果 all_device=False, 仅物理设备。
+        使用率在线程池中并行读取, 超时的挂载点 (例如卡住的 NFS) 标记为 unavailable。
         """
-        partitions = psutil.disk_partitions(all=all_device)
+        partitions = [
+            part for part in self._disk_partitions(all_device)
+            if part.device and part.fstype not in ["cgroup", "cgroup2", "tmpfs"]
+        ]
+        usages = self.disk_usages([part.mountpoint for part in partitions])
         return [
             Disk(
                 device=part.device,
                 mountpoint=part.mountpoint,
                 fstype=part.fstype,
                 opts=part.opts,
-                usage=self.get_disk_usage(part.mountpoint),
+                usage=usages.get(part.mountpoint),
+                status="ok" if usages.get(part.mountpoint) else "unavailable",
             )
             for part in partitions
-            if part.device and part.fstype not in ["cgroup", "cgroup2", "tmpfs"]
         ]
 
+    def _disk_partitions(self, all_device: bool) -> list:
+        """挂载点列表, /proc/self/mountinfo 没有变化时使用缓存"""
+        signature = _mountinfo_signature()
+        with self._lock:
+            if signature is None or signature != self._mounts_signature:
+                self._mounts.clear()
+                self._mounts_signature = signature
+            if all_device not in self._mounts:
+                self._mounts[all_device] = psutil.disk_partitions(all=all_device)
+                mountpoints = {part.mountpoint for part in self._mounts[all_device]}
+                if all_device:
+                    for mountpoint in list(self._usage_cache):
+                        if mountpoint not in mountpoints:
+                            del self._usage_cache[mountpoint]
+            return self._mounts[all_device]
+
+    def disk_usages(self, mountpoints: List[str]) -> Dict[str, Optional[DiskUsage]]:
+        """并行读取多个挂载点的使用率, 最多等待 usage_timeout 秒"""
+        now = time.monotonic()
+        result: Dict[str, Optional[DiskUsage]] = {}
+        waiting: Dict[str, Tuple[float, futures.Future]] = {}
+        with self._lock:
+            for mountpoint in set(mountpoints):
+                cached = self._usage_cache.get(mountpoint)
+                if cached and now - cached[0] < self.usage_ttl:
+                    result[mountpoint] = cached[1]
+                    continue
+                pending = self._usage_pending.get(mountpoint)
+                if pending is None:
+                    future = self._submit_usage(mountpoint)
+                    pending = self._usage_pending[mountpoint] = (now, future)
+                    future.add_done_callback(functools.partial(self._usage_done, mountpoint))
+                waiting[mountpoint] = pending
+        # 之前已经超时的挂载点不再等待
+        fresh = [
+            (submitted, future) for submitted, future in waiting.values()
+            if now - submitted < self.usage_timeout
+        ]
+        if fresh:
+            deadline = max(submitted for submitted, _ in fresh) + self.usage_timeout
+            futures.wait(
+                [future for _, future in fresh], timeout=max(deadline - time.monotonic(), 0)
+            )
+        for mountpoint, (_, future) in waiting.items():
+            if future.done() and not future.exception():
+                result[mountpoint] = future.result()
+            else:
+                if not future.done():
+                    logger.warning("read disk usage of {} timed out", mountpoint)
+                result[mountpoint] = None
+        return result
+
+    def _submit_usage(self, mountpoint: str) -> futures.Future:
+        """每个挂载点在单独的守护线程中读取
+
+        卡住的 NFS/FUSE 挂载点只占用自己的线程, 不会让其他挂载点排队等待,
+        每个挂载点同时只有一个线程, 线程数不超过挂载点数。
+        """
+        future: futures.Future = futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self.get_disk_usage(mountpoint))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"disk-usage {mountpoint}", daemon=True).start()
+        return future
+
+    def _usage_done(self, mountpoint: str, future: futures.Future):
+        usage = None if future.exception() else future.result()
+        with self._lock:
+            self._usage_pending.pop(mountpoint, None)
+            self._usage_cache[mountpoint] = (time.monotonic(), usage)
+
     def get_disk_usage(self, path):
         usage = psutil.disk_usage(path)
         return DiskUsage(total=usage.total, used=usage.used, free=usage.free, percent=usage.percent)
@@ -128,6 +576,12 @@ class NodeManager:
             net_ifs[interface].bytes_recv = stats.bytes_recv
             net_ifs[interface].packets_sent = stats.packets_sent
             net_ifs[interface].packets_recv = stats.packets_recv
+            net_ifs[interface].rx_rate = round(
+                self.metrics.store.latest(f"net.{interface}.rx") or 0
+            )
+            net_ifs[interface].tx_rate = round(
+                self.metrics.store.latest(f"net.{interface}.tx") or 0
+            )
 
         return list(net_ifs.values())
 
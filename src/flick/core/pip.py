@@ -1,11 +1,27 @@
+import asyncio
+import bisect
 import dataclasses
+import difflib
+import inspect
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import threading
+import time
+from email import parser
 from importlib import metadata
-from typing import List
+from typing import Any, Callable, Dict, List, Optional
 
 from loguru import logger
 
-from flick.common.utils import timed_lru_cache
-from flick.core import executor
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+except ImportError:
+    from pip._vendor.packaging.requirements import InvalidRequirement, Requirement
+
+from flick.core import exceptions, executor, pip_index
 
 PIP_REPOS = {
     "官方": "https://pypi.org/simple",
@@ -32,33 +48,385 @@ class PyPackage:
         return dataclasses.asdict(self)
 
 
+@dataclasses.dataclass
+class DistEntry:
+    """site-packages 中的一个 dist-info/egg-info 目录"""
+    name: str
+    version: str
+    summary: str
+    path: str
+    location: str
+    mtime: float
+
+
+def _read_headers(path: pathlib.Path) -> Optional[dict]:
+    """只解析元数据的头部, 跳过通常很长的 description
+
+    path 为 dist-info/egg-info 目录, 或者旧版 setuptools 安装的单个 egg-info 文件 (PKG-INFO 格式)。
+    """
+    files = [path] if path.is_file() else [path / "METADATA", path / "PKG-INFO"]
+    for file in files:
+        try:
+            with open(file, encoding="utf-8", errors="replace") as f:
+                lines = []
+                for line in f:
+                    if not line.strip():
+                        break
+                    lines.append(line)
+        except OSError:
+            continue
+        return parser.HeaderParser().parsestr("".join(lines))
+    return None
+
+
+class PackageInventory:
+    """已安装包的索引
+
+    按 sys.path 中每个目录的 mtime 判断是否有包安装或卸载,
+    目录变化时只重新解析 mtime 变化的 dist-info/egg-info, 未变化时不再读取磁盘。
+    同时维护规范化包名的索引, 用于精确查找和搜索。
+    """
+
+    def __init__(self, paths: Optional[List[str]] = None) -> None:
+        self.paths = paths
+        self._entries: Dict[str, List[DistEntry]] = {}
+        self._dir_mtimes: Dict[str, float] = {}
+        # 规范化包名 -> 按 sys.path 顺序排列的安装位置, 第一个为实际导入的版本
+        self._index: Dict[str, List[DistEntry]] = {}
+        self._names: List[str] = []
+        self._lock = threading.Lock()
+
+    def entries(self) -> List[DistEntry]:
+        with self._lock:
+            self._refresh()
+            return [entry for location in self._entries.values() for entry in location]
+
+    def get(self, name: str) -> Optional[DistEntry]:
+        with self._lock:
+            self._refresh()
+            entries = self._index.get(pip_index.canonical_name(name))
+            return entries[0] if entries else None
+
+    def search(self, query: str, limit: int = 20) -> List[DistEntry]:
+        """按前缀、包含、近似的顺序搜索包名"""
+        query = pip_index.canonical_name(query)
+        with self._lock:
+            self._refresh()
+            names = []
+            start = bisect.bisect_left(self._names, query)
+            for name in self._names[start:]:
+                if not name.startswith(query) or len(names) >= limit:
+                    break
+                names.append(name)
+            for name in self._names:
+                if len(names) >= limit:
+                    break
+                if query in name and name not in names:
+                    names.append(name)
+            if len(names) < limit:
+                for name in difflib.get_close_matches(query, self._names, n=limit, cutoff=0.7):
+                    if name not in names and len(names) < limit:
+                        names.append(name)
+            return [self._index[name][0] for name in names]
+
+    def _refresh(self):
+        changed = False
+        locations = []
+        for location in self.paths or sys.path:
+            location = os.path.abspath(location or ".")
+            try:
+                mtime = os.stat(location).st_mtime
+            except OSError:
+                continue
+            if location in locations or not os.path.isdir(location):
+                continue
+            locations.append(location)
+            if self._dir_mtimes.get(location) != mtime:
+                self._entries[location] = self._scan(location, self._entries.get(location, []))
+                self._dir_mtimes[location] = mtime
+                changed = True
+        for location in list(self._entries):
+            if location not in locations:
+                self._entries.pop(location)
+                self._dir_mtimes.pop(location, None)
+                changed = True
+        if changed:
+            self._index = {}
+            for location in locations:
+                for entry in self._entries.get(location, []):
+                    self._index.setdefault(pip_index.canonical_name(entry.name), []).append(entry)
+            self._names = sorted(self._index)
+
+    @staticmethod
+    def _scan(location: str, previous: List[DistEntry]) -> List[DistEntry]:
+        known = {entry.path: entry for entry in previous}
+        entries = []
+        with os.scandir(location) as it:
+            for item in it:
+                if item.name.endswith(".dist-info"):
+                    if not item.is_dir():
+                        continue
+                elif not item.name.endswith(".egg-info"):
+                    continue
+                mtime = item.stat().st_mtime
+                entry = known.get(item.path)
+                if entry is None or entry.mtime != mtime:
+                    headers = _read_headers(pathlib.Path(item.path))
+                    if not headers or not headers.get("Name"):
+                        continue
+                    entry = DistEntry(
+                        name=headers["Name"],
+                        version=headers.get("Version", ""),
+                        summary=headers.get("Summary", ""),
+                        path=item.path,
+                        location=location,
+                        mtime=mtime,
+                    )
+                entries.append(entry)
+        logger.debug("scanned {} packages in {}", len(entries), location)
+        return sorted(entries, key=lambda entry: entry.path)
+
+
+def is_newer(latest: str, current: str) -> bool:
+    try:
+        return pip_index.pkg_version.Version(latest) > pip_index.pkg_version.Version(current)
+    except pip_index.pkg_version.InvalidVersion:
+        return False
+
+
+class OutdatedScanner:
+    """检查所有已安装的包是否有新版本
+
+    并发查询索引 (请求速率由 PackageIndex 限制), 每得到一个结果就回调,
+    结果保留到下一次扫描。扫描进行中再次请求时, 加入当前扫描而不是重新开始。
+    """
+
+    def __init__(
+        self, inventory: PackageInventory, index: pip_index.PackageIndex, concurrency: int = 10
+    ) -> None:
+        self.inventory = inventory
+        self.index = index
+        self.concurrency = concurrency
+        self.results: Dict[str, dict] = {}
+        self.scanned_at = 0.0
+        self._listeners: List[Callable[[dict], Any]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._task and not self._task.done())
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "scanned_at": self.scanned_at,
+            "packages": list(self.results.values()),
+        }
+
+    async def scan(
+        self, on_result: Optional[Callable[[dict], Any]] = None, refresh: bool = False
+    ) -> List[dict]:
+        if not self.running:
+            self.results = {}
+            self._task = asyncio.create_task(self._run(refresh))
+        elif on_result:
+            # 加入进行中的扫描, 先补发已有的结果
+            for result in list(self.results.values()):
+                await self._notify(on_result, result)
+        if on_result:
+            self._listeners.append(on_result)
+        try:
+            return await asyncio.shield(self._task)
+        finally:
+            if on_result in self._listeners:
+                self._listeners.remove(on_result)
+
+    async def _run(self, refresh: bool) -> List[dict]:
+        entries: Dict[str, DistEntry] = {}
+        for entry in self.inventory.entries():
+            entries.setdefault(pip_index.canonical_name(entry.name), entry)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(entry: DistEntry):
+            result = {
+                "name": entry.name, "version": entry.version, "latest": "", "outdated": False,
+                "error": "",
+            }
+            async with semaphore:
+                try:
+                    versions = await self.index.versions(entry.name, refresh=refresh)
+                except exceptions.PackageIndexFailed as e:
+                    result["error"] = str(e)
+                else:
+                    if versions:
+                        result["latest"] = versions[0]
+                        result["outdated"] = is_newer(versions[0], entry.version)
+            self.results[pip_index.canonical_name(entry.name)] = result
+            for listener in list(self._listeners):
+                await self._notify(listener, result)
+
+        started = time.monotonic()
+        await asyncio.gather(*[check(entry) for entry in entries.values()])
+        self.scanned_at = time.time()
+        logger.info(
+            "scanned {} packages in {:.1f}s", len(entries), time.monotonic() - started
+        )
+        return list(self.results.values())
+
+    @staticmethod
+    async def _notify(listener: Callable[[dict], Any], result: dict):
+        try:
+            value = listener(result)
+            if inspect.isawaitable(value):
+                await value
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("notify outdated result failed")
+
+
+# PEP 508 的包名
+NAME_PATTERN = re.compile(r"^([A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])$", re.IGNORECASE)
+
+
+def package_name(name: str) -> str:
+    """校验包名, 不允许版本号或以 - 开头的 pip 参数, 格式错误时抛出 ValueError"""
+    if not NAME_PATTERN.match(name):
+        raise ValueError(f"invalid package name {name}")
+    return name
+
+
+def requirement_name(spec: str) -> str:
+    """需求描述中的包名, 格式错误时抛出 ValueError"""
+    if spec.startswith("-"):
+        raise ValueError(f"invalid requirement {spec}")
+    try:
+        return Requirement(spec).name
+    except InvalidRequirement as e:
+        raise ValueError(f"invalid requirement {spec}: {e}") from e
+
+
 class PythonManager:
 
-    def __init__(self) -> None:
-        self.pip_cmd = executor.Executor("python -m pip")
+    def __init__(self, timeout: float = 1800) -> None:
+        self.pip_cmd = executor.Executor([sys.executable, "-m", "pip"])
+        # 安装/卸载命令的超时时间 (秒)
+        self.timeout = timeout
+        # 本地 simple 索引代理的地址, 设置后安装时通过代理下载
+        self.proxy_url: Optional[str] = None
+        self.inventory = PackageInventory()
+        self.outdated = OutdatedScanner(self.inventory, pip_index.SERVICE)
+        self._mutation_lock = asyncio.Lock()
 
     def version(self) -> str:
         _, output = self.pip_cmd.execute("--version")
         values = output.strip().split()
         return values[1] if len(values) > 2 else ""
 
-    def install(self, name, upgrade=False, no_deps=False, force=False) -> PyPackage:
-        args = ["install"]
+    async def _mutate(self, *args, on_line=None, job_id=None, timeout=None):
+        """修改环境的 pip 命令依次执行, 避免并发修改 site-packages"""
+        async with self._mutation_lock:
+            return await self.pip_cmd.run(
+                *args, on_line=on_line, job_id=job_id, timeout=timeout or self.timeout
+            )
+
+    def _install_args(self, upgrade=False, no_deps=False, force=False) -> List[str]:
+        args = ["install", "--progress-bar", "off"]
+        if self.proxy_url:
+            args.extend(["--index-url", self.proxy_url])
         if upgrade:
             args.append("--upgrade")
         if no_deps:
             args.append("--no-deps")
         if force:
-            args.append("--force")
-        args.append(name)
-        self.pip_cmd.execute(*args)
-        return self.get_package(name=name.split("==")[0])
+            args.append("--force-reinstall")
+        return args
+
+    async def install(
+        self, name, upgrade=False, no_deps=False, force=False, on_line=None, job_id=None,
+    ) -> PyPackage:
+        requirement_name(name)
+        await self._mutate(
+            *self._install_args(upgrade=upgrade, no_deps=no_deps, force=force), name,
+            on_line=on_line, job_id=job_id,
+        )
+        return self.get_package(name=requirement_name(name))
+
+    async def upgrade(
+        self, name, version, no_deps=False, force=False, on_line=None, job_id=None,
+    ) -> PyPackage:
+        return await self.install(
+            f"{name}=={version}", upgrade=True, no_deps=no_deps, force=force,
+            on_line=on_line, job_id=job_id,
+        )
+
+    async def uninstall(self, name, on_line=None, job_id=None):
+        package_name(name)
+        await self._mutate("uninstall", "-y", name, on_line=on_line, job_id=job_id)
 
-    def upgrade(self, name, version, no_deps=False, force=False) -> PyPackage:
-        return self.install(f"{name}=={version}", upgrade=True, no_deps=no_deps, force=force)
+    async def batch(
+        self,
+        install: List[str],
+        uninstall: List[str],
+        upgrade=False,
+        no_deps=False,
+        force=False,
+        on_line=None,
+        job_id=None,
+    ) -> List[dict]:
+        """在一次 pip 调用中安装/升级一组包, 在另一次调用中卸载一组包
 
-    def uninstall(self, name):
-        self.pip_cmd.execute("uninstall", "-y", name)
+        install 为需求描述 (例如 foo==1.0, bar>=2), 所有包一起解析依赖。
+        返回每个包的结果 {name, action, before, after, success, error, cancelled},
+        任务被取消时, 当前和之后的命令中所有包都标记为已取消。
+        """
+        names = {spec: requirement_name(spec) for spec in install}
+        for name in uninstall:
+            package_name(name)
+        results = []
+        async with self._mutation_lock:
+            # 前后的版本都在锁内记录, 不会混入并发的其他修改
+            before = self._installed_versions()
+            commands = []
+            if uninstall:
+                commands.append(("uninstall", ["uninstall", "-y", *uninstall], uninstall))
+            if install:
+                args = self._install_args(upgrade=upgrade, no_deps=no_deps, force=force)
+                commands.append(("install", [*args, *install], [names[spec] for spec in install]))
+            cancelled = False
+            for action, args, packages in commands:
+                error = ""
+                if not cancelled:
+                    try:
+                        await self.pip_cmd.run(
+                            *args, on_line=on_line, job_id=job_id, timeout=self.timeout
+                        )
+                    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                        error = (e.output or str(e))[-2000:]
+                    except exceptions.CommandCancelled:
+                        cancelled = True
+                if cancelled:
+                    error = "cancelled"
+                results.extend(
+                    {"name": name, "action": action, "error": error, "cancelled": cancelled}
+                    for name in packages
+                )
+            after = self._installed_versions()
+        for result in results:
+            key = pip_index.canonical_name(result["name"])
+            result["before"] = before.get(key, "")
+            result["after"] = after.get(key, "")
+            if result["cancelled"]:
+                result["success"] = False
+            elif result["action"] == "uninstall":
+                result["success"] = not result["after"]
+            else:
+                result["success"] = bool(result["after"]) and not result["error"]
+        return results
+
+    def _installed_versions(self) -> Dict[str, str]:
+        versions: Dict[str, str] = {}
+        for entry in self.inventory.entries():
+            versions.setdefault(pip_index.canonical_name(entry.name), entry.version)
+        return versions
 
     def config_list(self) -> str:
         _, stdout = self.pip_cmd.execute("config", "list")
@@ -72,38 +440,42 @@ class PythonManager:
 
     def get_package(self, name) -> PyPackage:
         logger.info("get package {}", name)
-        dist = metadata.distribution(name)
+        entry = self.inventory.get(name)
+        if not entry:
+            raise metadata.PackageNotFoundError(name)
+        dist = metadata.PathDistribution(pathlib.Path(entry.path))
         return PyPackage(
-            name=dist.metadata["Name"],
-            version=dist.metadata["Version"],
-            sumary=dist.metadata["Summary"],
+            name=entry.name,
+            version=entry.version,
+            sumary=entry.summary,
             metadata="\n".join(self._get_metadata(dist)),
+            path=entry.location,
+        )
+
+    def _to_package(self, entry: DistEntry, detail=False) -> PyPackage:
+        package = PyPackage(
+            name=entry.name, version=entry.version, sumary=entry.summary, path=entry.location
         )
+        if detail:
+            dist = metadata.PathDistribution(pathlib.Path(entry.path))
+            package.metadata = "\n".join(self._get_metadata(dist))
+        return package
 
-    def list_packages(self, name=None) -> List[PyPackage]:
+    def list_packages(self, name=None, detail=False) -> List[PyPackage]:
+        """列出已安装的包, detail=True 时包含完整的元数据"""
         logger.info("list packages with name={}", name)
-        dists = metadata.distributions()
         if name:
-            dists = [dist for dist in dists if dist.name == name]
-        return [
-            PyPackage(
-                name=dist.name,
-                version=dist.version,
-                sumary=dist.metadata["Summary"],
-                metadata="\n".join(self._get_metadata(dist)),
-                path=str(dist.locate_file(""))
-            )
-            for dist in dists
-            if dist.name
-        ]
-
-    @timed_lru_cache(seconds=3600)
-    def get_package_versions(self, name) -> List[str]:
-        _, stdout = self.pip_cmd.execute("index", "versions", name)
-        for line in stdout.split("\n"):
-            if line.startswith("Available versions:"):
-                return [v.strip() for v in line.split(":")[-1].split(",")]
-        return []
+            entry = self.inventory.get(name)
+            entries = [entry] if entry else []
+        else:
+            entries = self.inventory.entries()
+        return [self._to_package(entry, detail=detail) for entry in entries]
+
+    def search_packages(self, query, limit=20) -> List[PyPackage]:
+        return [self._to_package(entry) for entry in self.inventory.search(query, limit=limit)]
+
+    async def get_package_versions(self, name) -> List[str]:
+        return await pip_index.SERVICE.versions(name)
 
 
 SERVICE = PythonManager()
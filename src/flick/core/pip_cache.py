@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+from typing import Dict, List, Optional
+from urllib import parse
+
+import httpx
+from loguru import logger
+
+from flick.common import utils
+from flick.core import exceptions, pip_index
+
+
+class WheelCache:
+    """pip 下载缓存和 simple 索引代理
+
+    项目页面从上游索引获取后缓存 ttl 秒, 上游不可用时继续使用过期的页面。
+    文件按 sha256 保存在 blobs 目录中, 同一个文件只下载一次,
+    并发请求同一个文件时共用一次下载, 上游超过 read_timeout 秒没有数据时下载失败。
+    项目页面的读写和缓存统计在线程池中执行, 不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        root: Optional[pathlib.Path] = None,
+        index: Optional[pip_index.PackageIndex] = None,
+        ttl: float = 600,
+        read_timeout: float = 60,
+    ) -> None:
+        self.root = root or utils.data_path("flick").joinpath("pip-cache")
+        self.index = index or pip_index.SERVICE
+        self.ttl = ttl
+        self.read_timeout = read_timeout
+        # 上游索引, 为空时使用 pip 配置的索引
+        self.upstream: Optional[str] = None
+        self._pages: Dict[str, dict] = {}
+        self._downloads: Dict[str, asyncio.Future] = {}
+
+    def blob_path(self, sha256: str) -> pathlib.Path:
+        return self.root / "blobs" / sha256[:2] / sha256
+
+    def _page_path(self, name: str) -> pathlib.Path:
+        return self.root / "projects" / f"{name}.json"
+
+    async def _load_page(self, name: str) -> Optional[dict]:
+        if name not in self._pages:
+            loop = asyncio.get_running_loop()
+            page = await loop.run_in_executor(None, self._read_page, self._page_path(name))
+            if page is None:
+                return None
+            self._pages.setdefault(name, page)
+        return self._pages[name]
+
+    @staticmethod
+    def _read_page(path: pathlib.Path) -> Optional[dict]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    async def _save_page(self, name: str, page: dict):
+        self._pages[name] = page
+        # 在事件循环中序列化, 线程池写入时页面可能正在被修改
+        data = json.dumps(page)
+        path = self._page_path(name)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_page, path, data)
+        except OSError as e:
+            logger.warning("save project page of {} failed: {}", name, e)
+
+    @staticmethod
+    def _write_page(path: pathlib.Path, data: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 每次写入使用不同的临时文件, 同一个页面并发保存时不会互相覆盖
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    async def files(self, name: str) -> List[dict]:
+        """项目的文件列表, 格式与 PEP 691 JSON 相同"""
+        name = pip_index.canonical_name(name)
+        page = await self._load_page(name)
+        if page and time.time() - page["fetched_at"] < self.ttl:
+            return page["files"]
+        try:
+            files = await self._fetch_page(name)
+        except exceptions.PackageIndexFailed as e:
+            if page:
+                logger.warning("use stale project page of {}: {}", name, e)
+                return page["files"]
+            raise
+        await self._save_page(name, {"fetched_at": time.time(), "files": files})
+        return files
+
+    async def _fetch_page(self, name: str) -> List[dict]:
+        upstream = (self.upstream or pip_index.configured_index_url()).rstrip("/")
+        url = f"{upstream}/{name}/"
+        await self.index.limiter.acquire()
+        try:
+            resp = await self.index.client.get(url)
+        except httpx.HTTPError as e:
+            raise exceptions.PackageIndexFailed(name, str(e)) from e
+        if resp.status_code >= 400:
+            raise exceptions.PackageIndexFailed(name, f"{resp.status_code} {resp.reason_phrase}")
+        if "json" not in resp.headers.get("content-type", ""):
+            return pip_index.parse_html(resp.text, str(resp.url))
+        files = []
+        for item in resp.json().get("files") or []:
+            files.append({
+                "filename": item.get("filename", ""),
+                "url": parse.urljoin(str(resp.url), item.get("url", "")),
+                "hashes": item.get("hashes") or {},
+                "requires-python": item.get("requires-python"),
+                "yanked": item.get("yanked", False),
+            })
+        return files
+
+    async def open(self, name: str, filename: str) -> pathlib.Path:
+        """返回缓存文件的路径, 不存在时先从上游下载"""
+        item = next((f for f in await self.files(name) if f["filename"] == filename), None)
+        if item is None:
+            raise exceptions.PackageIndexFailed(name, f"file {filename} not found")
+        sha256 = item["hashes"].get("sha256")
+        if sha256 and self.blob_path(sha256).exists():
+            return self.blob_path(sha256)
+
+        key = item["url"]
+        if key not in self._downloads:
+            self._downloads[key] = asyncio.ensure_future(self._download(name, item))
+            self._downloads[key].add_done_callback(lambda _: self._downloads.pop(key, None))
+        return await asyncio.shield(self._downloads[key])
+
+    async def _download(self, name: str, item: dict) -> pathlib.Path:
+        expected = item["hashes"].get("sha256")
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        # 单个 chunk 的读取超时, 整个下载不限时间
+        timeout = httpx.Timeout(self.index.timeout, read=self.read_timeout)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as f:
+            try:
+                async with self.index.client.stream("GET", item["url"], timeout=timeout) as resp:
+                    if resp.status_code >= 400:
+                        raise exceptions.PackageIndexFailed(
+                            name, f"download {item['filename']}: {resp.status_code}"
+                        )
+                    async for chunk in resp.aiter_bytes(256 * 1024):
+                        digest.update(chunk)
+                        # 写入磁盘在线程池中执行, 不阻塞事件循环
+                        await loop.run_in_executor(None, f.write, chunk)
+            except (httpx.HTTPError, exceptions.PackageIndexFailed) as e:
+                os.unlink(f.name)
+                if isinstance(e, httpx.HTTPError):
+                    raise exceptions.PackageIndexFailed(name, str(e) or repr(e)) from e
+                raise
+            except asyncio.CancelledError:
+                os.unlink(f.name)
+                raise
+        sha256 = digest.hexdigest()
+        if expected and expected != sha256:
+            os.unlink(f.name)
+            raise exceptions.PackageIndexFailed(
+                name, f"sha256 of {item['filename']} mismatch: {sha256}"
+            )
+        path = self.blob_path(sha256)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(f.name, path)
+        logger.info(
+            "cached {} ({} bytes) in {:.1f}s", item["filename"], path.stat().st_size,
+            time.monotonic() - started,
+        )
+        if not expected:
+            # 上游没有提供 hash, 记录下来以便下次直接命中缓存
+            page = await self._load_page(pip_index.canonical_name(name))
+            if page:
+                for file in page["files"]:
+                    if file["filename"] == item["filename"]:
+                        file["hashes"]["sha256"] = sha256
+                await self._save_page(pip_index.canonical_name(name), page)
+        return path
+
+    async def stats(self) -> dict:
+        count, size = await asyncio.get_running_loop().run_in_executor(None, self._blob_usage)
+        return {"path": str(self.root), "files": count, "size": size, "upstream": self.upstream}
+
+    def _blob_usage(self):
+        count = size = 0
+        for path in (self.root / "blobs").glob("*/*"):
+            try:
+                size += path.stat().st_size
+            except OSError:
+                # 统计期间被删除
+                continue
+            count += 1
+        return count, size
+
+
+SERVICE = WheelCache()
@@ -0,0 +1,279 @@
+import asyncio
+import configparser
+import dataclasses
+import html
+import os
+import pathlib
+import re
+import sys
+import time
+from typing import Dict, List, Optional, Set
+from urllib import parse
+
+import httpx
+import tinydb
+from loguru import logger
+
+try:
+    from packaging import version as pkg_version
+except ImportError:
+    from pip._vendor.packaging import version as pkg_version
+
+from flick.common import storage, utils
+from flick.core import exceptions
+
+DEFAULT_INDEX_URL = "https://pypi.org/simple"
+
+ACCEPT = ", ".join([
+    "application/vnd.pypi.simple.v1+json",
+    "application/vnd.pypi.simple.v1+html;q=0.2",
+    "text/html;q=0.1",
+])
+
+SDIST_SUFFIXES = (".tar.gz", ".tar.bz2", ".tgz", ".zip")
+
+
+def canonical_name(name: str) -> str:
+    """PEP 503 规范化包名"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _pip_config_files() -> List[pathlib.Path]:
+    """按 pip 的优先级从低到高返回配置文件"""
+    if os.getenv("PIP_CONFIG_FILE"):
+        return [pathlib.Path(os.environ["PIP_CONFIG_FILE"])]
+    home = pathlib.Path.home()
+    xdg_config = pathlib.Path(os.getenv("XDG_CONFIG_HOME") or home / ".config")
+    return [
+        pathlib.Path("/etc/xdg/pip/pip.conf"),
+        pathlib.Path("/etc/pip.conf"),
+        home / ".pip" / "pip.conf",
+        xdg_config / "pip" / "pip.conf",
+        pathlib.Path(sys.prefix) / "pip.conf",
+    ]
+
+
+def configured_index_url() -> str:
+    """读取 pip 配置的 index-url, 与 pip config set global.index-url 保持一致"""
+    if os.getenv("PIP_INDEX_URL"):
+        return os.environ["PIP_INDEX_URL"]
+    index_url = DEFAULT_INDEX_URL
+    parser = configparser.RawConfigParser()
+    for path in _pip_config_files():
+        try:
+            parser.read(path)
+        except (OSError, configparser.Error) as e:
+            logger.warning("read pip config {} failed: {}", path, e)
+    for section in ["global", "install"]:
+        if parser.has_option(section, "index-url"):
+            index_url = parser.get(section, "index-url")
+    return index_url
+
+
+def version_of(filename: str) -> Optional[str]:
+    """从 wheel/sdist 文件名中解析版本号"""
+    if filename.endswith((".whl", ".egg")):
+        parts = filename.split("-")
+        return parts[1] if len(parts) > 2 else None
+    for suffix in SDIST_SUFFIXES:
+        if filename.endswith(suffix):
+            base = filename[: -len(suffix)]
+            return base.rsplit("-", 1)[1] if "-" in base else None
+    return None
+
+
+def parse_html(content: str, base_url: str = "") -> List[dict]:
+    """解析 PEP 503 HTML 页面, 返回与 JSON 格式相同的文件列表"""
+    files = []
+    for attrs, filename in re.findall(r"<a\s([^>]*)>([^<]*)</a>", content, re.IGNORECASE):
+        values = {
+            key.lower(): html.unescape(value)
+            for key, value in re.findall(r'([\w-]+)\s*=\s*"([^"]*)"', attrs)
+        }
+        url, _, fragment = values.get("href", "").partition("#")
+        hash_name, _, hash_value = fragment.partition("=")
+        files.append({
+            "filename": html.unescape(filename.strip()),
+            "url": parse.urljoin(base_url, url),
+            "hashes": {hash_name: hash_value} if hash_value else {},
+            "requires-python": values.get("data-requires-python"),
+            "yanked": "data-yanked" in attrs,
+        })
+    return files
+
+
+def sort_versions(files: List[dict], pre: bool = False) -> List[str]:
+    """返回未被撤回的版本, 从新到旧排列, 默认不包括预发布版本"""
+    versions: Set[pkg_version.Version] = set()
+    for item in files:
+        if item.get("yanked"):
+            continue
+        value = version_of(item.get("filename", ""))
+        if not value:
+            continue
+        try:
+            parsed = pkg_version.Version(value)
+        except pkg_version.InvalidVersion:
+            continue
+        if parsed.is_prerelease and not pre:
+            continue
+        versions.add(parsed)
+    return [str(value) for value in sorted(versions, reverse=True)]
+
+
+class RateLimiter:
+    """限制每秒发起的请求数"""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        wait = max(self._next - now, 0)
+        self._next = max(now, self._next) + self.interval
+        if wait:
+            await asyncio.sleep(wait)
+
+
+@dataclasses.dataclass
+class CachedProject:
+    key: str
+    name: str
+    index_url: str
+    versions: List[str] = dataclasses.field(default_factory=list)
+    etag: str = ""
+    last_modified: str = ""
+    fetched_at: float = 0
+
+
+class PackageIndex:
+    """PEP 691 simple API 客户端
+
+    通过连接池访问 pip 配置的索引, 不支持 JSON 的镜像回退到 PEP 503 HTML。
+    每个包单独缓存并持久化, ttl 内直接使用缓存,
+    过期后通过 ETag/Last-Modified 重新验证, 未变化时不重新下载。
+    向索引发起的请求不超过每秒 rate 个。
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[pathlib.Path] = None,
+        ttl: float = 600,
+        timeout: float = 10,
+        max_connections: int = 20,
+        rate: float = 20,
+    ) -> None:
+        self.db_file = db_path or utils.data_path("flick").joinpath("pip_index.json")
+        self.ttl = ttl
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections
+        )
+        self.limiter = RateLimiter(rate)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache: Optional[Dict[str, CachedProject]] = None
+        # 批量查询时合并写入, 整个表只序列化一次, 在线程池中写入
+        self._saver = storage.TableSaver(
+            self.db_file, "projects",
+            lambda: [dataclasses.asdict(project) for project in self.cache.values()],
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=self.limits, timeout=self.timeout, follow_redirects=True,
+                headers={"Accept": ACCEPT},
+            )
+        return self._client
+
+    async def close(self):
+        self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def cache(self) -> Dict[str, CachedProject]:
+        if self._cache is None:
+            self._cache = {}
+            if not self.db_file.exists():
+                return self._cache
+            try:
+                with tinydb.TinyDB(self.db_file) as db:
+                    for doc in db.table("projects").all():
+                        project = CachedProject(**doc)
+                        self._cache[project.key] = project
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("load pip index cache failed: {}", e)
+        return self._cache
+
+    def flush(self):
+        """立即把缓存写入磁盘"""
+        if self._cache is not None:
+            self._saver.save()
+
+    def _save(self, project: CachedProject):
+        logger.debug("update pip index cache {}", project.key)
+        self._saver.schedule()
+
+    async def versions(
+        self, name: str, index_url: Optional[str] = None, pre: bool = False,
+        refresh: bool = False,
+    ) -> List[str]:
+        """查询包的所有可用版本, 从新到旧排列"""
+        return (await self.project(name, index_url=index_url, pre=pre, refresh=refresh)).versions
+
+    async def project(
+        self, name: str, index_url: Optional[str] = None, pre: bool = False,
+        refresh: bool = False,
+    ) -> CachedProject:
+        index_url = (index_url or configured_index_url()).rstrip("/")
+        key = f"{index_url}/{canonical_name(name)}" + ("?pre" if pre else "")
+        project = self.cache.get(key)
+        if project and not refresh and time.time() - project.fetched_at < self.ttl:
+            return project
+
+        headers = {}
+        if project and project.etag:
+            headers["If-None-Match"] = project.etag
+        if project and project.last_modified:
+            headers["If-Modified-Since"] = project.last_modified
+        await self.limiter.acquire()
+        try:
+            resp = await self.client.get(f"{index_url}/{canonical_name(name)}/", headers=headers)
+        except httpx.HTTPError as e:
+            raise exceptions.PackageIndexFailed(name, str(e)) from e
+        if resp.status_code == 404:
+            raise exceptions.PackageIndexFailed(name, "package not found")
+        if project and resp.status_code == 304:
+            logger.debug("package {} not modified", name)
+            project.fetched_at = time.time()
+            self._save(project)
+            return project
+        if resp.status_code >= 400:
+            raise exceptions.PackageIndexFailed(name, f"{resp.status_code} {resp.reason_phrase}")
+
+        if "json" in resp.headers.get("content-type", ""):
+            try:
+                files = resp.json().get("files") or []
+            except ValueError as e:
+                raise exceptions.PackageIndexFailed(name, f"invalid json: {e}") from e
+        else:
+            files = parse_html(resp.text, str(resp.url))
+        project = CachedProject(
+            key=key,
+            name=name,
+            index_url=index_url,
+            versions=sort_versions(files, pre=pre),
+            etag=resp.headers.get("etag", ""),
+            last_modified=resp.headers.get("last-modified", ""),
+            fetched_at=time.time(),
+        )
+        self.cache[key] = project
+        self._save(project)
+        return project
+
+
+SERVICE = PackageIndex()
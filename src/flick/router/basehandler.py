@@ -1,9 +1,10 @@
+import base64
 import dataclasses
 import json
 import uuid
 from concurrent import futures
 from functools import lru_cache
-from typing import Optional, Union
+from typing import Any, Callable, List, Optional, Sequence, Union
 
 import jsonschema
 import jwt
@@ -23,6 +24,15 @@ def make_request_id():
     return f"req-{uuid.uuid4()}"
 
 
+def encode_cursor(key: str) -> str:
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    """格式错误时抛出 ValueError, urlsafe_b64decode 会忽略非法字符, 这里严格校验"""
+    return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+
+
 class BaseRequestHandler(web.RequestHandler):
     executor = futures.ThreadPoolExecutor()
 
@@ -92,6 +102,74 @@ class BaseRequestHandler(web.RequestHandler):
             return dataclasses.asdict(obj)  # type: ignore
         return obj.__dict__
 
+    def project(self, item: Any, fields: List[str]) -> Any:
+        """只保留 fields 中的字段"""
+        if not fields:
+            return item
+        if dataclasses.is_dataclass(item):
+            # 只允许数据字段, 方法和属性不能作为字段输出
+            names = {field.name for field in dataclasses.fields(item)}
+            return {field: getattr(item, field) for field in fields if field in names}
+        return {field: item[field] for field in fields if field in item}
+
+    async def finish_items(
+        self,
+        name: str,
+        items: Sequence,
+        key: Callable[[Any], str],
+        flush_every: int = 100,
+        **extra,
+    ):
+        """输出列表, 支持以下参数
+
+        - limit/cursor: 按 key 排序后分页, 下一页的 cursor 在 next_cursor 中返回
+        - fields: 以逗号分隔的字段, 只返回这些字段
+        - format=ndjson: 每行一个对象, 边序列化边发送, next_cursor 在响应头 X-Next-Cursor 中,
+          extra 中的每一项以 JSON 放在响应头 X-<Name> 中 (例如 cache -> X-Cache)
+        """
+        try:
+            limit = int(self.get_argument("limit", "0") or 0)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            self.finish_badrequest("limit must be a non-negative integer")
+            return
+        try:
+            cursor = decode_cursor(self.get_argument("cursor", ""))
+        except ValueError:
+            self.finish_badrequest("invalid cursor")
+            return
+        fields = [field for field in self.get_argument("fields", "").split(",") if field]
+        next_cursor = None
+        if limit or cursor:
+            items = sorted(items, key=key)
+            if cursor:
+                items = [item for item in items if key(item) > cursor]
+            if limit and len(items) > limit:
+                items = items[:limit]
+                next_cursor = encode_cursor(key(items[-1]))
+
+        if self.get_argument("format", "") != "ndjson":
+            self.finish(
+                dict(extra, next_cursor=next_cursor,
+                     **{name: [self.project(item, fields) for item in items]})
+            )
+            return
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        if next_cursor:
+            self.set_header("X-Next-Cursor", next_cursor)
+        for extra_name, value in extra.items():
+            self.set_header(
+                "X-" + extra_name.replace("_", "-").title(),
+                json.dumps(value, default=self._serialize),
+            )
+        for index, item in enumerate(items, start=1):
+            super().write(json.dumps(self.project(item, fields), default=self._serialize) + "\n")
+            if index % flush_every == 0:
+                await self.flush()
+        self.finish()
+
     def get_body(self) -> dict:
         return json.loads(self.request.body.decode())
 
@@ -104,9 +182,26 @@ class BaseRequestHandler(web.RequestHandler):
             self.finish_badrequest(f"invalid body: {str(e)}")
             return None
 
+    def get_lease(self, default: int = 300) -> Union[int, None]:
+        """订阅的有效时间 (秒), 不是正整数时返回 400 并返回 None"""
+        try:
+            lease = int(self.get_argument("lease", str(default)))
+        except ValueError:
+            lease = 0
+        if lease <= 0:
+            self.finish_badrequest("lease must be a positive number of seconds")
+            return None
+        return lease
+
+    @property
+    def event_topic(self) -> str:
+        """事件主题为请求路径的第一段, 例如 /docker/images -> docker"""
+        topic = self.request.path.strip("/").split("/")[0]
+        return topic if topic in sse.TOPICS else ""
+
     async def send_event(self, event_name, level=None, detail=None, item=None):
         await sse.SSE_SERVICE.get_channel(self.get_cookie("sid", "")).send_event(
-            event_name, level=level, detail=detail, item=item
+            event_name, level=level, detail=detail, item=item, topic=self.event_topic
         )
 
     async def run_on_executor(self, fn):
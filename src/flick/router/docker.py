@@ -1,47 +1,105 @@
+import asyncio
+import json
+import re
+import uuid
 from urllib import parse
 
 import docker.errors
 from loguru import logger
+from tornado import iostream
 
-from flick.common import context, utils
-from flick.core import container
+from flick.common import utils
+from flick.core import container, container_logs, container_stats, exceptions
 from flick.router import basehandler
 from flick.router.schemas import docker as docker_schema
+from flick.service import sse
 
 
 class System(basehandler.BaseRequestHandler):
 
-    def get(self):
-        self.finish({"system": container.SERVICE.system()})
+    async def get(self):
+        self.finish({"system": await container.SERVICE.system()})
 
 
 class Images(basehandler.BaseRequestHandler):
 
-    def get(self):
+    async def get(self):
         show_intermediate = utils.strtobool(self.get_argument("show_intermediate", ""))
-        self.finish({"images": container.SERVICE.images(show_intermediate=show_intermediate)})
+        refresh = utils.strtobool(self.get_argument("refresh", ""))
+        images = await container.SERVICE.images(
+            show_intermediate=show_intermediate,
+            refresh=refresh,
+            label=self.get_argument("label", None),
+            name=self.get_argument("name", None),
+        )
+        await self.finish_items(
+            "images", images, key=lambda image: image.id,
+            cache=container.SERVICE.inventory.status("images"),
+        )
 
-    def delete(self):
-        container.SERVICE.prune_images()
+    async def post(self):
+        """拉取镜像, 同时尝试多个镜像加速地址"""
+        body = self.validate_json_body(docker_schema.image_action_pull)
+        if not body:
+            return
+        name = body["image"].strip()
+        self.finish(status=202)
+
+        async def on_progress(source, layers):
+            await self.send_event(
+                "pull image progress",
+                detail=name,
+                item={"source": source, "layers": layers},
+            )
+
+        try:
+            image = await container.SERVICE.pull_image(
+                name,
+                mirrors=body.get("mirrors"),
+                on_progress=on_progress,
+                parallel=body.get("parallel"),
+            )
+        except (exceptions.ImagePullFailed, docker.errors.APIError) as e:
+            logger.error("pull image {} failed: {}", name, e)
+            await self.send_event("pull image failed", level="error", detail=name)
+        else:
+            await self.send_event(
+                "pulled image", level="success", detail=name, item=image.to_json()
+            )
+
+    async def delete(self):
+        await container.SERVICE.prune_images()
         self.finish()
 
 
+class Mirrors(basehandler.BaseRequestHandler):
+
+    def get(self):
+        self.finish({"mirrors": [score.to_json() for score in container.SERVICE.mirror_scores()]})
+
+    async def post(self):
+        """立即重新探测所有镜像加速地址"""
+        scores = await container.SERVICE.probe_mirrors()
+        self.finish({"mirrors": [score.to_json() for score in scores]})
+
+
 class Image(basehandler.BaseRequestHandler):
 
-    def delete(self, image_id):
+    async def delete(self, image_id):
         force = utils.strtobool(self.get_argument("force", default="false"))
         try:
-            container.SERVICE.remove_image(image_id, force=force)
+            await container.SERVICE.remove_image(image_id, force=force)
         except docker.errors.APIError as e:
             logger.error("delete image {} failed: {}", image_id, e)
             self.finish_internalerror(str(e))
+            return
 
         self.finish()
 
 
 class ImageTags(basehandler.BaseRequestHandler):
 
-    def post(self, image_id):
+    async def post(self, image_id):
         """添加镜像Tag"""
         image_id = parse.unquote(image_id)
         body = self.validate_json_body(docker_schema.image_action_add_tag)
@@ -53,34 +111,48 @@ class ImageTags(basehandler.BaseRequestHandler):
             self.finish_badrequest(f"invalid tag: {new_tag}")
             return
 
-        container.SERVICE.add_image_tag(image_id, values[0], values[1] if len(values) == 2 else "")
-        self.finish({"image": container.SERVICE.get_image(image_id)})
+        await container.SERVICE.add_image_tag(
+            image_id, values[0], values[1] if len(values) == 2 else ""
+        )
+        self.finish({"image": await container.SERVICE.get_image(image_id)})
 
 
 class ImageTag(basehandler.BaseRequestHandler):
 
-    def delete(self, image_id, tag):
+    async def delete(self, image_id, tag):
         """删除镜像Tag"""
-        image = container.SERVICE.get_image(image_id)
+        image = await container.SERVICE.get_image(image_id)
         if tag not in image.tags:
             self.finish_badrequest(f"image has no tag '{tag}'")
             return
-        container.SERVICE.remove_image(tag)
+        await container.SERVICE.remove_image(tag)
         if len(image.tags) <= 1:
             self.finish()
         else:
-            self.finish({"image": container.SERVICE.get_image(image_id)})
+            self.finish({"image": await container.SERVICE.get_image(image_id)})
 
 
 class Containers(basehandler.BaseRequestHandler):
 
-    def get(self):
+    async def get(self):
         all_status = utils.strtobool(self.get_argument("all_status", ""))
-        self.finish({"containers": container.SERVICE.containers(all_status=all_status)})
+        refresh = utils.strtobool(self.get_argument("refresh", ""))
+        containers = await container.SERVICE.containers(
+            all_status=all_status,
+            refresh=refresh,
+            status=self.get_argument("status", None),
+            image=self.get_argument("image", None),
+            label=self.get_argument("label", None),
+            name=self.get_argument("name", None),
+        )
+        await self.finish_items(
+            "containers", containers, key=lambda item: item.id,
+            cache=container.SERVICE.inventory.status("containers"),
+        )
 
-    def post(self):
+    async def post(self):
         body = self.get_body()
-        container.SERVICE.run_container(
+        await container.SERVICE.run_container(
             body.get("image"), name=body.get("name"),
             auto_remove=body.get("autoRemove", False),
             command=body.get("command"),
@@ -90,12 +162,12 @@ class Containers(basehandler.BaseRequestHandler):
 
 class Container(basehandler.BaseRequestHandler):
 
-    def get(self, id_or_name):
-        self.finish({"container": container.SERVICE.get_container(id_or_name)})
+    async def get(self, id_or_name):
+        self.finish({"container": await container.SERVICE.get_container(id_or_name)})
 
-    def delete(self, id_or_name):
+    async def delete(self, id_or_name):
         force = utils.strtobool(self.get_argument("force", default="false"))
-        container.SERVICE.rm_container(id_or_name, force=force)
+        await container.SERVICE.rm_container(id_or_name, force=force)
 
     async def put(self, id_or_name):
         body = self.get_body()
@@ -104,7 +176,10 @@ class Container(basehandler.BaseRequestHandler):
             self.finish(status=202)
             # task.submit(self._start_container_and_wait, self.get_token_id(), id_or_name)
             try:
-                updated = await self._start_container_and_wait(id_or_name)
+                updated = await container.SERVICE.start_container(id_or_name)
+                updated = await container.SERVICE.wait_container_status(
+                    updated, ["running", "active"]
+                )
             except Exception as e:
                 logger.error("start container {} failed: {}", id_or_name, e)
                 await self.send_event(
@@ -113,6 +188,7 @@ class Container(basehandler.BaseRequestHandler):
                     detail=id_or_name,
                 )
             else:
+                logger.info("started container {}", id_or_name)
                 await self.send_event(
                     "started container",
                     level="success",
@@ -122,10 +198,13 @@ class Container(basehandler.BaseRequestHandler):
 
         elif status in ["stop"]:
             self.finish(status=202)
-            current = container.SERVICE.get_container(id_or_name)
+            current = await container.SERVICE.get_container(id_or_name)
             try:
-                updated = await self._stop_container_and_wait(id_or_name)
-            except docker.errors.NotFound:
+                updated = await container.SERVICE.stop_container(id_or_name)
+                updated = await container.SERVICE.wait_container_status(
+                    updated, ["exited", "stopped"]
+                )
+            except (docker.errors.NotFound, exceptions.ContainerNotExists):
                 # container may be removed because attr: AutoRemove.
                 await self.send_event(
                     "deleted container",
@@ -141,6 +220,7 @@ class Container(basehandler.BaseRequestHandler):
                     detail=id_or_name,
                 )
             else:
+                logger.info("stopped container {}", id_or_name)
                 await self.send_event(
                     "stopped container",
                     level="success",
@@ -149,37 +229,152 @@ class Container(basehandler.BaseRequestHandler):
                 )
 
         elif status in ["pause"]:
-            container.SERVICE.pause_container(id_or_name)
+            await container.SERVICE.pause_container(id_or_name)
             self.finish({"result": "accept"})
         elif status in ["unpause"]:
-            container.SERVICE.unpause_container(id_or_name)
+            await container.SERVICE.unpause_container(id_or_name)
             self.finish({"result": "accept"})
         else:
             self.finish_badrequest(f"invalid status {status}")
 
-    @context.preserve_context_and_run_on_executor
-    def _start_container_and_wait(self, id_or_name: str):
-        updated = container.SERVICE.start_container(id_or_name, wait=True)
-        logger.info("started container {}", id_or_name)
-        return updated
 
-    @context.preserve_context_and_run_on_executor
-    def _stop_container_and_wait(self, id_or_name: str):
-        updated = container.SERVICE.stop_container(id_or_name, wait=True)
-        logger.info("stopped container {}", id_or_name)
-        return updated
+class ContainerActions(basehandler.BaseRequestHandler):
 
+    async def post(self):
+        """批量执行容器操作, 每个容器的结果通过 SSE 返回"""
+        body = self.validate_json_body(docker_schema.container_batch_action)
+        if not body:
+            return
+        action = body["action"]
+        batch_id = f"batch-{uuid.uuid4()}"
+        self.finish({"batch": batch_id}, status=202)
 
-class Volumes(basehandler.BaseRequestHandler):
+        async def on_result(id_or_name, updated, error):
+            if error:
+                await self.send_event(
+                    f"{action} container failed",
+                    level="error",
+                    detail=id_or_name,
+                    item={"batch": batch_id, "error": str(error)},
+                )
+            else:
+                await self.send_event(
+                    f"{action} container success",
+                    level="success",
+                    detail=id_or_name,
+                    item={"batch": batch_id, "container": updated.to_json() if updated else None},
+                )
+
+        results = await container.SERVICE.batch_container_action(
+            body["ids"],
+            action,
+            concurrency=body.get("concurrency"),
+            on_result=on_result,
+            force=body.get("force", False),
+            timeout=body.get("timeout"),
+        )
+        failed = [key for key, error in results.items() if error]
+        await self.send_event(
+            f"batch {action} containers finished",
+            level="warning" if failed else "success",
+            detail=f"{len(results) - len(failed)}/{len(results)}",
+            item={"batch": batch_id, "failed": failed},
+        )
+
+
+class ContainerStats(basehandler.BaseRequestHandler):
 
     def get(self):
-        self.finish({"volumes": container.SERVICE.volumes()})
+        self.finish({"stats": container_stats.SERVICE.snapshot()})
 
     def post(self):
+        """订阅容器资源统计, 通过 SSE 定时推送"""
+        session_id = self.get_cookie("sid", "")
+        lease = self.get_lease()
+        if lease is None:
+            return
+
+        async def publish(frame):
+            await sse.SSE_SERVICE.get_channel(session_id).send_event(
+                "container stats", item={"stats": frame}, topic="docker"
+            )
+
+        container_stats.SERVICE.subscribe(session_id, publish, lease=lease)
+        self.finish({"interval": container_stats.SERVICE.interval, "lease": lease})
+
+    def delete(self):
+        container_stats.SERVICE.unsubscribe(self.get_cookie("sid", ""))
+        self.finish()
+
+
+class ContainerLogs(basehandler.BaseRequestHandler):
+
+    _follow_task = None
+
+    async def get(self, id_or_name):
+        """以 SSE 的形式持续输出容器日志"""
+        try:
+            tail = int(self.get_argument("tail", "100"))
+            since = int(self.get_argument("since", "0")) or None
+            expression = self.get_argument("filter", "")
+            pattern = re.compile(expression) if expression else None
+        except (ValueError, re.error) as e:
+            self.finish_badrequest(f"invalid argument: {e}")
+            return
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Connection", "keep-alive")
+        self._follow_task = asyncio.create_task(
+            self._send_logs(id_or_name, tail=tail, since=since, pattern=pattern)
+        )
+        try:
+            await self._follow_task
+        except asyncio.CancelledError:
+            logger.info("stop following logs of {}", id_or_name)
+        except (docker.errors.APIError, exceptions.DockerConnectionFailed) as e:
+            self.write(f"event: error\ndata: {json.dumps(str(e))}\n\n")
+        except iostream.StreamClosedError:
+            return
+        if not self._finished:
+            self.finish()
+
+    async def _send_logs(self, id_or_name, tail=100, since=None, pattern=None):
+        async for lines, dropped in container_logs.SERVICE.follow(
+            id_or_name, tail=tail, since=since, pattern=pattern
+        ):
+            if dropped:
+                # 客户端读取过慢, 只告知丢弃的行数
+                self.write(f"event: dropped\ndata: {json.dumps({'count': dropped})}\n\n")
+            for line in lines:
+                self.write(f"data: {json.dumps(line)}\n\n")
+            if lines or dropped:
+                await self.flush()
+
+    def on_connection_close(self):
+        if self._follow_task:
+            self._follow_task.cancel()
+
+
+class Volumes(basehandler.BaseRequestHandler):
+
+    async def get(self):
+        refresh = utils.strtobool(self.get_argument("refresh", ""))
+        volumes = await container.SERVICE.volumes(
+            refresh=refresh,
+            label=self.get_argument("label", None),
+            name=self.get_argument("name", None),
+        )
+        await self.finish_items(
+            "volumes", volumes, key=lambda volume: volume.name,
+            cache=container.SERVICE.inventory.status("volumes"),
+        )
+
+    async def post(self):
         body = self.get_body()
         self.finish(
             {
-                "volume": container.SERVICE.create_volume(
+                "volume": await container.SERVICE.create_volume(
                     name=body.get("name"), driver=body.get("driver"), label=body.get("label")
                 )
             }
@@ -188,9 +383,9 @@ class Volumes(basehandler.BaseRequestHandler):
 
 class Volume(basehandler.BaseRequestHandler):
 
-    def get(self, name):
-        self.finish({"volume": container.SERVICE.get_volume(name)})
+    async def get(self, name):
+        self.finish({"volume": await container.SERVICE.get_volume(name)})
 
-    def delete(self, name):
-        container.SERVICE.rm_volume(name)
+    async def delete(self, name):
+        await container.SERVICE.rm_volume(name)
         self.finish()
@@ -1,6 +1,9 @@
-from flick.common import utils
+import time
+
+from flick.common import context, utils
 from flick.core import node
 from flick.router import basehandler
+from flick.service import telemetry
 
 
 class Info(basehandler.BaseRequestHandler):
@@ -12,7 +15,12 @@ class Info(basehandler.BaseRequestHandler):
 class Cpu(basehandler.BaseRequestHandler):
 
     def get(self):
-        self.finish({"cpu": node.SERVICE.cpu()})
+        try:
+            history = float(self.get_query_argument("history", "0"))
+        except ValueError:
+            self.finish_badrequest("history must be a number of minutes")
+            return
+        self.finish({"cpu": node.SERVICE.cpu(history=history * 60)})
 
 
 class Memory(basehandler.BaseRequestHandler):
@@ -23,12 +31,54 @@ class Memory(basehandler.BaseRequestHandler):
 
 class Partitions(basehandler.BaseRequestHandler):
 
-    def get(self):
+    async def get(self):
         all_device = utils.strtobool(self.get_query_argument("all_device", ''))
-        self.finish({"partitions": node.SERVICE.partitions(all_device=all_device)})
+        self.finish({"partitions": await self.list_partitions(all_device)})
+
+    @context.preserve_context_and_run_on_executor
+    def list_partitions(self, all_device):
+        return node.SERVICE.partitions(all_device=all_device)
 
 
 class NetInterfaces(basehandler.BaseRequestHandler):
 
     def get(self):
         return self.finish({"net_interfaces": node.SERVICE.net_interfaces()})
+
+
+class Metrics(basehandler.BaseRequestHandler):
+
+    def get(self):
+        """since 为时间戳, 负数表示最近多少秒; step 为 1/60/3600 秒, 不指定时自动选择"""
+        try:
+            since = float(self.get_query_argument("since", "-300"))
+            step = int(self.get_query_argument("step", "0"))
+        except ValueError:
+            self.finish_badrequest("since and step must be numbers")
+            return
+        if since < 0:
+            since += time.time()
+        names = [name for name in self.get_query_argument("names", "").split(",") if name]
+        node.SERVICE.metrics.start()
+        self.finish({"metrics": node.SERVICE.metrics.store.query(since, step or None, names)})
+
+
+class Telemetry(basehandler.BaseRequestHandler):
+
+    def post(self):
+        """订阅节点监控数据, 通过 SSE 推送, topics 为逗号分隔的主题"""
+        topics = {topic for topic in self.get_argument("topics", "").split(",") if topic}
+        topics = topics or set(telemetry.TOPICS)
+        unknown = topics - set(telemetry.TOPICS)
+        if unknown:
+            self.finish_badrequest(f"unknown topics: {','.join(sorted(unknown))}")
+            return
+        lease = self.get_lease()
+        if lease is None:
+            return
+        telemetry.SERVICE.subscribe(self.get_cookie("sid", ""), topics, lease=lease)
+        self.finish({"topics": sorted(topics), "lease": lease})
+
+    def delete(self):
+        telemetry.SERVICE.unsubscribe(self.get_cookie("sid", ""))
+        self.finish()
@@ -1,11 +1,35 @@
+import asyncio
+import html
 import subprocess
 from urllib import parse
 
 from loguru import logger
 
-from flick.common import context
-from flick.core import pip
+from flick.common import context, utils
+from flick.core import exceptions, executor, pip, pip_cache
 from flick.router import basehandler
+from flick.router.schemas import pip as pip_schema
+
+
+PIP_ERRORS = (
+    subprocess.CalledProcessError, subprocess.TimeoutExpired, exceptions.CommandCancelled,
+)
+
+
+class PipHandler(basehandler.BaseRequestHandler):
+
+    def output_sender(self, job_id):
+        """把 pip 的输出逐行推送到 SSE"""
+
+        async def send(stream, line):
+            await self.send_event(
+                "pip output",
+                level="warning" if stream == "stderr" else "info",
+                detail=line,
+                item={"job": job_id, "stream": stream},
+            )
+
+        return send
 
 
 class Version(basehandler.BaseRequestHandler):
@@ -14,17 +38,27 @@ class Version(basehandler.BaseRequestHandler):
         return self.finish({"version": pip.SERVICE.version()})
 
 
-class Packages(basehandler.BaseRequestHandler):
+class Packages(PipHandler):
 
     async def get(self):
+        query = self.get_query_argument("search", None)
+        if query:
+            self.finish({"packages": await self.search_packages(query)})
+            return
         name = self.get_query_argument("name", None)
-        packages = await self.list_packages(name=name)
+        detail = utils.strtobool(self.get_query_argument("detail", ""))
+        packages = await self.list_packages(name=name, detail=detail)
         logger.debug("list packages: {}", len(packages))
         self.finish({"packages": packages})
 
     @context.preserve_context_and_run_on_executor
-    def list_packages(self, name=None):
-        return pip.SERVICE.list_packages(name=name)
+    def list_packages(self, name=None, detail=False):
+        return pip.SERVICE.list_packages(name=name, detail=detail)
+
+    @context.preserve_context_and_run_on_executor
+    def search_packages(self, query):
+        # 可能触发重新扫描 site-packages
+        return pip.SERVICE.search_packages(query)
 
     async def post(self):
         data = self.get_body()
@@ -35,21 +69,30 @@ class Packages(basehandler.BaseRequestHandler):
         if not name:
             self.finish_badrequest({"success": False, "error": "name is required"})
             return
+        try:
+            pip.requirement_name(name)
+        except ValueError as e:
+            self.finish_badrequest(str(e))
+            return
 
-        self.finish(status=202)
+        job_id = executor.new_job_id()
+        self.finish({"job": job_id}, status=202)
         try:
-            package = await self._install_package(
+            package = await pip.SERVICE.install(
                 name,
                 upgrade=upgrade,
                 no_deps=no_deps,
                 force=force,
+                on_line=self.output_sender(job_id),
+                job_id=job_id,
             )
-        except subprocess.CalledProcessError as e:
+        except PIP_ERRORS as e:
             logger.error(f"Failed to install package {name}: {e}")
             await self.send_event(
                 "install package failed",
                 level="error",
                 detail=name,
+                item={"job": job_id, "error": str(e)},
             )
         else:
             await self.send_event(
@@ -59,24 +102,26 @@ class Packages(basehandler.BaseRequestHandler):
                 item=package.to_json(),
             )
 
-    @context.preserve_context_and_run_on_executor
-    async def _install_package(self, name, upgrade=False, no_deps=False, force=False):
-        return pip.SERVICE.install(name, upgrade=upgrade, no_deps=no_deps, force=force)
-
 
-class Package(basehandler.BaseRequestHandler):
+class Package(PipHandler):
 
     async def delete(self, name):
-        self.finish({}, status=202)
-        # task.submit(self._uninstall_package_and_wait, self.get_token_id(), name)
         try:
-            await self._uninstall_package_and_wait(name)
-        except subprocess.CalledProcessError as e:
+            pip.package_name(name)
+        except ValueError as e:
+            self.finish_badrequest(str(e))
+            return
+        job_id = executor.new_job_id()
+        self.finish({"job": job_id}, status=202)
+        try:
+            await pip.SERVICE.uninstall(name, on_line=self.output_sender(job_id), job_id=job_id)
+        except PIP_ERRORS as e:
             logger.error(f"Failed to uninstall package {name}: {e}")
             await self.send_event(
                 "update package failed",
                 level="error",
                 detail=name,
+                item={"job": job_id, "error": str(e)},
             )
         else:
             await self.send_event(
@@ -89,54 +134,209 @@ class Package(basehandler.BaseRequestHandler):
         data = self.get_body()
         version = data.get("version")
         if version:
-            # task.submit(
-            #     self._update_package_and_wait,
-            #     self.get_token_id(),
-            #     name,
-            #     version,
-            #     no_deps=data.get("noDeps", False),
-            #     force=data.get("force", False),
-            # )
             try:
-                package = await self._update_package_and_wait(
-                    name, version, no_deps=data.get("noDeps", False), force=data.get("force", False)
-                )
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to install package {name}: {e}")
-                await self.send_event(
-                    "update package failed",
-                    level="error",
-                    detail=name,
-                )
-            else:
-                logger.info("update package {} -> {} success", name, version)
-                await self.send_event(
-                    "updated package",
-                    level="success",
-                    detail=name,
-                    item=package.to_json(),
-                )
-        self.finish({}, status=202)
+                pip.requirement_name(f"{name}=={version}")
+            except ValueError as e:
+                self.finish_badrequest(str(e))
+                return
+        job_id = executor.new_job_id()
+        self.finish({"job": job_id} if version else {}, status=202)
+        if not version:
+            return
+        try:
+            package = await pip.SERVICE.upgrade(
+                name,
+                version,
+                no_deps=data.get("noDeps", False),
+                force=data.get("force", False),
+                on_line=self.output_sender(job_id),
+                job_id=job_id,
+            )
+        except PIP_ERRORS as e:
+            logger.error(f"Failed to install package {name}: {e}")
+            await self.send_event(
+                "update package failed",
+                level="error",
+                detail=name,
+                item={"job": job_id, "error": str(e)},
+            )
+        else:
+            logger.info("update package {} -> {} success", name, version)
+            await self.send_event(
+                "updated package",
+                level="success",
+                detail=name,
+                item=package.to_json(),
+            )
 
-    @context.preserve_context_and_run_on_executor
-    def _uninstall_package_and_wait(self, name):
-        pip.SERVICE.uninstall(name)
 
-    @context.preserve_context_and_run_on_executor
-    def _update_package_and_wait(self, name, version, no_deps=False, force=False):
-        return pip.SERVICE.upgrade(name, version, no_deps=no_deps, force=force)
+class Jobs(basehandler.BaseRequestHandler):
+
+    def get(self):
+        """正在运行的 pip 命令"""
+        self.finish({"jobs": [job.to_json() for job in executor.Executor.jobs.values()]})
+
+
+class Job(basehandler.BaseRequestHandler):
+
+    def delete(self, job_id):
+        if not executor.Executor.cancel(job_id):
+            self.set_status(404)
+            self.finish({"error": f"job {job_id} not found"})
+            return
+        self.finish()
 
 
 class PackageVersion(basehandler.BaseRequestHandler):
 
-    def get(self, name):
+    async def get(self, name):
         try:
-            self.finish({"versions": pip.SERVICE.get_package_versions(name)})
-        except subprocess.CalledProcessError as e:
+            self.finish({"versions": await pip.SERVICE.get_package_versions(name)})
+        except exceptions.PackageIndexFailed as e:
             logger.error("Failed to get package version of {}: {}", name, e)
             self.finish({"error": str(e)}, 500)
 
 
+class Batch(PipHandler):
+
+    async def post(self):
+        """批量安装/升级/卸载, 所有包在一次 pip 调用中完成, 每个包的结果通过 SSE 推送"""
+        body = self.validate_json_body(pip_schema.package_batch_action)
+        if not body:
+            return
+        install, uninstall = body.get("install", []), body.get("uninstall", [])
+        try:
+            for spec in install:
+                pip.requirement_name(spec)
+            for name in uninstall:
+                pip.package_name(name)
+        except ValueError as e:
+            self.finish_badrequest(str(e))
+            return
+        job_id = executor.new_job_id()
+        self.finish({"job": job_id}, status=202)
+
+        results = await pip.SERVICE.batch(
+            install,
+            uninstall,
+            upgrade=body.get("upgrade", False),
+            no_deps=body.get("noDeps", False),
+            force=body.get("force", False),
+            on_line=self.output_sender(job_id),
+            job_id=job_id,
+        )
+        for result in results:
+            if result["cancelled"]:
+                name, level = f"{result['action']} package cancelled", "warning"
+            elif result["success"]:
+                name, level = f"{result['action']}ed package", "success"
+            else:
+                name, level = f"{result['action']} package failed", "error"
+            await self.send_event(name, level=level, detail=result["name"], item=result)
+        failed = [result["name"] for result in results if not result["success"]]
+        cancelled = any(result["cancelled"] for result in results)
+        await self.send_event(
+            "batch finished",
+            level="warning" if cancelled else ("error" if failed else "success"),
+            item={
+                "job": job_id, "total": len(results), "failed": failed, "cancelled": cancelled,
+            },
+        )
+
+
+class Outdated(basehandler.BaseRequestHandler):
+
+    def get(self):
+        """返回上一次扫描的结果"""
+        self.finish(pip.SERVICE.outdated.status())
+
+    async def post(self):
+        """扫描可以升级的包, 每个包的结果通过 SSE 推送"""
+        refresh = utils.strtobool(self.get_argument("refresh", ""))
+        self.finish({"running": pip.SERVICE.outdated.running}, status=202)
+
+        async def publish(result):
+            await self.send_event(
+                "package checked",
+                level="warning" if result["outdated"] else "info",
+                detail=result["name"],
+                item=result,
+            )
+
+        results = await pip.SERVICE.outdated.scan(on_result=publish, refresh=refresh)
+        await self.send_event(
+            "outdated scan finished",
+            level="success",
+            item={
+                "total": len(results),
+                "outdated": len([result for result in results if result["outdated"]]),
+                "failed": len([result for result in results if result["error"]]),
+            },
+        )
+
+
+class SimpleIndex(basehandler.BaseRequestHandler):
+    """本地 simple 索引 (PEP 503), 文件由 pip_cache 缓存"""
+
+    async def get(self, project):
+        try:
+            files = await pip_cache.SERVICE.files(project)
+        except exceptions.PackageIndexFailed as e:
+            self.set_status(404)
+            self.finish({"error": str(e)})
+            return
+        links = []
+        for item in files:
+            href = parse.quote(item["filename"])
+            if item["hashes"].get("sha256"):
+                href += f"#sha256={item['hashes']['sha256']}"
+            attrs = f'href="{href}"'
+            if item.get("requires-python"):
+                attrs += f' data-requires-python="{html.escape(item["requires-python"])}"'
+            if item.get("yanked"):
+                reason = item["yanked"] if isinstance(item["yanked"], str) else ""
+                attrs += f' data-yanked="{html.escape(reason)}"'
+            links.append(f"<a {attrs}>{html.escape(item['filename'])}</a><br/>")
+        self.set_header("Content-Type", "text/html; charset=utf-8")
+        self.finish(
+            "<!DOCTYPE html>\n<html><body>\n" + "\n".join(links) + "\n</body></html>\n"
+        )
+
+
+class SimpleFile(basehandler.BaseRequestHandler):
+
+    async def get(self, project, filename):
+        try:
+            path = await pip_cache.SERVICE.open(project, filename)
+        except exceptions.PackageIndexFailed as e:
+            logger.error("fetch {} failed: {}", filename, e)
+            self.set_status(404)
+            self.finish({"error": str(e)})
+            return
+        self.set_header("Content-Type", "application/octet-stream")
+        self.set_header("Content-Length", path.stat().st_size)
+        loop = asyncio.get_running_loop()
+        # 文件读取在线程池中执行, 不阻塞事件循环
+        f = await loop.run_in_executor(None, open, path, "rb")
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, 256 * 1024)
+                if not chunk:
+                    break
+                self.write(chunk)
+                await self.flush()
+        finally:
+            await loop.run_in_executor(None, f.close)
+        self.finish()
+
+
+class Cache(basehandler.BaseRequestHandler):
+
+    async def get(self):
+        stats = await pip_cache.SERVICE.stats()
+        self.finish({"cache": {**stats, "proxy": pip.SERVICE.proxy_url}})
+
+
 class Repos(basehandler.BaseRequestHandler):
 
     def get(self):
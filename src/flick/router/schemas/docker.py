@@ -5,3 +5,25 @@ image_action_add_tag = {
     },
     "required": ["tag"]
 }
+
+image_action_pull = {
+    "type": "object",
+    "properties": {
+        "image": {"type": "string", "minLength": 1},
+        "mirrors": {"type": "array", "items": {"type": "string"}},
+        "parallel": {"type": "integer", "minimum": 1},
+    },
+    "required": ["image"]
+}
+
+container_batch_action = {
+    "type": "object",
+    "properties": {
+        "ids": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1},
+        "action": {"enum": ["start", "stop", "restart", "pause", "unpause", "remove"]},
+        "concurrency": {"type": "integer", "minimum": 1, "maximum": 100},
+        "force": {"type": "boolean"},
+        "timeout": {"type": "integer", "minimum": 0},
+    },
+    "required": ["ids", "action"]
+}
@@ -0,0 +1,14 @@
+package_batch_action = {
+    "type": "object",
+    "properties": {
+        "install": {"type": "array", "items": {"type": "string", "minLength": 1}},
+        "uninstall": {"type": "array", "items": {"type": "string", "minLength": 1}},
+        "upgrade": {"type": "boolean"},
+        "noDeps": {"type": "boolean"},
+        "force": {"type": "boolean"},
+    },
+    "anyOf": [
+        {"properties": {"install": {"minItems": 1}}, "required": ["install"]},
+        {"properties": {"uninstall": {"minItems": 1}}, "required": ["uninstall"]},
+    ],
+}
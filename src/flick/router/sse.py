@@ -1,7 +1,7 @@
-import json
+import asyncio
 
-import tornado
 from loguru import logger
+from tornado import iostream
 
 from flick.router import basehandler
 from flick.service import sse
@@ -9,30 +9,72 @@ from flick.service import sse
 
 class SSE(basehandler.BaseRequestHandler):
 
-    def _send_event(self, request: tornado.web.RequestHandler, event: sse.Event):
-        message = f"data: {json.dumps(event.to_json())}\n\n"
-        request.write(message)
+    _send_task = None
 
     async def get(self):
         session_id = self.get_argument("session_id", "")
         if not session_id:
             self.finish_badrequest({"error": "channel_id is required"})
             return
-        logger.info("receive sse connection")
+        topics = {topic for topic in self.get_argument("topics", "").split(",") if topic}
+        unknown = topics - set(sse.TOPICS)
+        if unknown:
+            self.finish_badrequest(f"unknown topics: {','.join(sorted(unknown))}")
+            return
+        last_event_id = self.request.headers.get("Last-Event-ID") or self.get_argument(
+            "last_event_id", ""
+        )
+        logger.info("receive sse connection, last event id: {}", last_event_id or None)
 
         self.set_header("Content-Type", "text/event-stream")
         self.set_header("Cache-Control", "no-cache")
         self.set_header("Connection", "keep-alive")
 
-        channel = sse.SSE_SERVICE.new_channel(session_id)
-        await channel.send_event("sse connected", level="success")
+        channel = sse.SSE_SERVICE.get_channel(session_id)
+        subscriber = channel.subscribe(
+            int(last_event_id) if last_event_id.isdigit() else None, topics=topics
+        )
+        try:
+            self.write(sse.new_event("sse connected", level="success").frame())
+            if subscriber.reset:
+                # 服务重启或通道被回收, 之前的事件已经丢失
+                logger.warning("last event id {} is ahead of {}", last_event_id, channel)
+                self.write(sse.new_event("sse events reset", level="warning").frame())
+            self._send_task = asyncio.create_task(self._send_events(subscriber))
+            await self._send_task
+        except (asyncio.CancelledError, iostream.StreamClosedError):
+            logger.warning("sse 链接断开")
+        finally:
+            channel.unsubscribe(subscriber)
+
+    async def _send_events(self, subscriber: sse.Subscriber):
+        service = sse.SSE_SERVICE
+        await self.flush()
         while True:
-            event = await channel.get()
-            logger.debug("receive event from {}[{}]: {}", channel, channel.size(), event.to_json())
-            message = f"data: {json.dumps(event.to_json())}\n\n"
-            self.write(message)
-            self.flush()
-            # logger.debug("sent event {}: {}", channel, event.to_json())
+            events, dropped = await subscriber.read(timeout=service.heartbeat)
+            if not events and not dropped:
+                # 心跳, 及时发现已经断开的连接
+                self.write(b": ping\n\n")
+                await self.flush()
+                continue
+            if service.coalesce:
+                # 合并短时间内连续到达的事件, 一次写入
+                await asyncio.sleep(service.coalesce)
+                more, more_dropped = await subscriber.read(timeout=0)
+                events, dropped = events + more, dropped + more_dropped
+            frames = []
+            if dropped:
+                # 客户端离线太久, 缓冲区中的部分事件已被覆盖
+                event = sse.new_event(
+                    "sse events dropped", level="warning", item={"count": dropped}
+                )
+                frames.append(event.frame())
+            for event_id, event in events:
+                frames.append(event.frame(event_id))
+            logger.debug("send {} events to {}", len(events), subscriber.channel)
+            self.write(b"".join(frames))
+            await self.flush()
 
     def on_connection_close(self):
-        logger.warning("sse 链接断开")
+        if self._send_task:
+            self._send_task.cancel()
@@ -1,10 +1,18 @@
-
 from loguru import logger
 
 from flick.router import basehandler
 from flick.service import webrequest
 
 
+def _timeout(data: dict, key: str):
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError(f"{key} must be a positive number")
+    return value
+
+
 class Requests(basehandler.BaseRequestHandler):
 
     async def get(self):
@@ -14,6 +22,7 @@ class Requests(basehandler.BaseRequestHandler):
         self.finish({"requests": [request.model_dump() for request in requests]}, status=200)
 
     async def post(self):
+        """请求在后台发送, 完成、失败或取消后通过 SSE 推送结果"""
         data = self.get_body()
         method = data.get("method")
         url = data.get("url")
@@ -22,18 +31,45 @@ class Requests(basehandler.BaseRequestHandler):
         if not method or not url:
             self.finish_badrequest({"success": False, "error": "method or url is required"})
             return
-
         try:
-            request = webrequest.SERVICE.send_request(method, url, body=body, headers=headers)
-        except RuntimeError as e:
-            self.finish_internalerror({"success": False, "error": str(e)})
+            connect_timeout = _timeout(data, "connectTimeout")
+            read_timeout = _timeout(data, "readTimeout")
+        except ValueError as e:
+            self.finish_badrequest({"success": False, "error": str(e)})
             return
+
+        request = webrequest.SERVICE.create_request(method, url, body=body, headers=headers)
         self.finish({"request": request.model_dump()}, status=202)
+        request = await webrequest.SERVICE.send_request(
+            request, connect_timeout=connect_timeout, read_timeout=read_timeout
+        )
+        if request.status == webrequest.DONE:
+            await self.send_event(
+                "web request completed", level="success", detail=url, item=request.model_dump()
+            )
+        elif request.status == webrequest.CANCELLED:
+            await self.send_event(
+                "web request cancelled", level="warning", detail=url, item=request.model_dump()
+            )
+        else:
+            await self.send_event(
+                "web request failed", level="error", detail=url, item=request.model_dump()
+            )
 
 
 class Request(basehandler.BaseRequestHandler):
 
     async def delete(self, req_id):
-        logger.info("list all web requests")
+        logger.info("delete web request {}", req_id)
         webrequest.SERVICE.delete_request(int(req_id))
         self.finish(status=204)
+
+
+class RequestCancel(basehandler.BaseRequestHandler):
+
+    def post(self, req_id):
+        if not webrequest.SERVICE.cancel(int(req_id)):
+            self.set_status(404)
+            self.finish({"error": f"request {req_id} is not running"})
+            return
+        self.finish()
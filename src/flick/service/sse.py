@@ -1,9 +1,18 @@
 import asyncio
+import collections
 import dataclasses
-from typing import Dict
+import json
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 from loguru import logger
 
+TOPICS = ["docker", "pip", "node", "webrequest"]
+
+# 缓冲区满时的处理方式: 丢弃最早的事件 / 丢弃新事件
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
 
 @dataclasses.dataclass
 class Event:
@@ -12,59 +21,226 @@ class Event:
     detail: str = ""
     item: dict = dataclasses.field(default_factory=dict)
     timestramp: float = 0
+    # 事件所属的模块 (docker/pip/node/webrequest), 为空时发送给所有订阅者
+    topic: str = ""
+
+    # 序列化后的内容, 广播给多个连接时只序列化一次 (不是 dataclass 字段)
+    _encoded = None
 
     def to_json(self):
         return dataclasses.asdict(self)
 
+    def encode(self) -> bytes:
+        if self._encoded is None:
+            self._encoded = json.dumps(self.to_json()).encode()
+        return self._encoded
+
+    def frame(self, event_id: Optional[int] = None) -> bytes:
+        """SSE 消息, 只有 id 部分是每个连接单独生成的"""
+        prefix = f"id: {event_id}\n".encode() if event_id is not None else b""
+        return prefix + b"data: " + self.encode() + b"\n\n"
+
     def __str__(self) -> str:
         return f"<Event '{self.name}'>"
 
 
-def new_event(name, detail="", level="info", item=None) -> Event:
-    return Event(name=name, level=level, detail=detail, item=item or {})
+def new_event(name, detail="", level="info", item=None, topic="") -> Event:
+    return Event(name=name, level=level, detail=detail, item=item or {}, topic=topic)
+
+
+class Subscriber:
+    """通道的一个订阅者 (例如一个浏览器标签页), 有自己的读取位置和主题过滤"""
+
+    def __init__(
+        self,
+        channel: "Channel",
+        cursor: int,
+        topics: Optional[Set[str]] = None,
+        reset: bool = False,
+    ) -> None:
+        self.channel = channel
+        self.cursor = cursor
+        self.topics = topics or set()
+        # Last-Event-ID 比通道中的 id 还大, 说明通道在服务重启或回收后重新开始编号
+        self.reset = reset
+
+    def accepts_topic(self, topic: str) -> bool:
+        return not self.topics or not topic or topic in self.topics
+
+    def accepts(self, event: Event) -> bool:
+        return self.accepts_topic(event.topic)
+
+    async def read(self, timeout: Optional[float] = None) -> Tuple[List[Tuple[int, Event]], int]:
+        """读取下一批匹配的事件, 返回 (事件, 被覆盖的匹配事件数), 超时返回空列表"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            events, dropped = await self.channel.read(
+                self.cursor, timeout=remaining, accepts=self.accepts_topic
+            )
+            if events:
+                self.cursor = events[-1][0]
+            matched = [(event_id, event) for event_id, event in events if self.accepts(event)]
+            self.channel.mark_delivered(event_id for event_id, _ in matched)
+            if matched or dropped or not events:
+                return matched, dropped
 
 
 class Channel:
+    """一个会话的事件通道
 
-    def __init__(self, session_id) -> None:
+    事件保存在固定大小的环形缓冲区中, 每个事件有递增的 id,
+    同一个会话的多个连接各自订阅, 都能收到全部事件,
+    断线重连的客户端可以从 Last-Event-ID 之后继续读取。
+    同一个事件对象可以放入多个通道, id 由通道分配, 不修改事件本身。
+    """
+
+    def __init__(self, session_id, size: int = 1000, overflow: str = DROP_OLDEST) -> None:
         self.session_id = session_id
-        self.events = asyncio.Queue()
+        self.size_limit = size
+        self.overflow = overflow
+        self.events: Deque[Tuple[int, Event]] = collections.deque(maxlen=size)
+        self.last_id = 0
+        # 这个 id 及之前的事件都已发送给至少一个连接, 新连接从这里开始读取
+        self.delivered = 0
+        # 大于 delivered 但已经发送过的 id (被其他连接的主题过滤跳过的事件不在其中)
+        self._received: Set[int] = set()
+        # 最近被覆盖的事件 (id, 主题), 用于按主题统计丢失的事件数
+        self._evicted: Deque[Tuple[int, str]] = collections.deque(maxlen=size * 4)
+        self.dropped = 0
+        self.subscribers: List[Subscriber] = []
+        self.last_active = time.monotonic()
+        self._changed = asyncio.Event()
 
     def __str__(self) -> str:
         return f"Channel({id(self)} sid: {self.session_id})"
 
     def size(self):
-        return self.events.qsize()
+        return len(self.events)
 
-    # def event_stream(self):
-    #     while True:
-    #         event = self.events.get()
-    #         yield f"data: {json.dumps(event)}\n\n"
+    def pending(self) -> int:
+        return self.last_id - self.delivered
 
     async def put(self, event: Event):
-        logger.debug("{} (queue: {}) put event: {}", self, id(self.events), event)
-        await self.events.put(event)
-
-    async def get(self) -> Event:
-        return await self.events.get()  # type: ignore
+        logger.debug("{} (pending: {}) put event: {}", self, self.pending(), event)
+        if self.overflow == DROP_NEWEST and self.pending() >= self.size_limit:
+            self.dropped += 1
+            logger.warning("{} is full, drop event {}", self, event)
+            return
+        self.last_id += 1
+        if len(self.events) == self.events.maxlen:
+            evicted_id, evicted = self.events[0]
+            self._evicted.append((evicted_id, evicted.topic))
+            self._received.discard(evicted_id)
+            self.delivered = max(self.delivered, evicted_id)
+        self.events.append((self.last_id, event))
+        self._changed.set()
 
     def empty(self) -> bool:
-        return self.events.empty()
+        return not self.pending()
 
-    async def send_event(self, event_name: str, level=None, detail=None, item=None):
+    async def send_event(self, event_name: str, level=None, detail=None, item=None, topic=None):
         event = Event(
             name=event_name,
             level=level or "info",
             detail=detail or "",
             item=item or {},
+            topic=topic or "",
         )
         await self.put(event)
 
+    async def read(
+        self,
+        after: int,
+        timeout: Optional[float] = None,
+        accepts: Optional[Callable[[str], bool]] = None,
+    ) -> Tuple[List[Tuple[int, Event]], int]:
+        """读取 id 大于 after 的事件, 返回 (事件, 缓冲区中已被覆盖的事件数)
+
+        accepts 为主题过滤, 只统计匹配的被覆盖事件。timeout 秒内没有新事件时返回空列表。
+        """
+        while self.last_id <= after:
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return [], 0
+        self.last_active = time.monotonic()
+        events = [(event_id, event) for event_id, event in self.events if event_id > after]
+        return events, self._dropped_since(after, accepts)
+
+    def _dropped_since(self, after: int, accepts: Optional[Callable[[str], bool]]) -> int:
+        first = self.events[0][0] if self.events else self.last_id + 1
+        if first <= after + 1:
+            return 0
+        dropped = sum(
+            1 for event_id, topic in self._evicted
+            if after < event_id < first and (accepts is None or accepts(topic))
+        )
+        # 更早被覆盖的事件没有记录主题, 全部计入
+        tracked = self._evicted[0][0] if self._evicted else first
+        return dropped + max(min(tracked, first) - after - 1, 0)
+
+    def mark_delivered(self, event_ids: Iterable[int]):
+        """记录已经发送的事件, delivered 只越过所有连接都跳过的事件之前的连续部分"""
+        self._received.update(event_id for event_id in event_ids if event_id > self.delivered)
+        for event_id, _ in self.events:
+            if event_id <= self.delivered:
+                continue
+            if event_id not in self._received:
+                break
+            self._received.discard(event_id)
+            self.delivered = event_id
+
+    @property
+    def connections(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(
+        self, last_event_id: Optional[int] = None, topics: Optional[Set[str]] = None
+    ) -> Subscriber:
+        """新的订阅者从 last_event_id 之后开始读取, 未指定时从尚未发送的事件开始
+
+        last_event_id 大于通道中最大的 id 时, 通道已经重新编号, 从头读取缓冲区中的事件。
+        """
+        reset = last_event_id is not None and last_event_id > self.last_id
+        if last_event_id is None:
+            cursor = self.delivered
+        else:
+            cursor = 0 if reset else last_event_id
+        subscriber = Subscriber(self, cursor, topics, reset=reset)
+        self.subscribers.append(subscriber)
+        self.last_active = time.monotonic()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        self.last_active = time.monotonic()
+
 
 class SSEService:
+    """管理所有会话的事件通道, 没有连接且空闲超过 idle_timeout 秒的通道会被回收
+
+    连接在 coalesce 秒内收到的事件合并为一次写入, 超过 heartbeat 秒没有事件时发送心跳注释。
+    """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        channel_size: int = 1000,
+        overflow: str = DROP_OLDEST,
+        idle_timeout: float = 600,
+        coalesce: float = 0.05,
+        heartbeat: float = 15,
+    ) -> None:
+        self.channel_size = channel_size
+        self.overflow = overflow
+        self.idle_timeout = idle_timeout
+        self.coalesce = coalesce
+        self.heartbeat = heartbeat
         self.channels: Dict[str, Channel] = {}
+        self._gc_task: Optional[asyncio.Task] = None
 
     def get_channel(self, session_id) -> Channel:
         if session_id not in self.channels:
@@ -73,15 +249,38 @@ class SSEService:
 
     def new_channel(self, session_id) -> Channel:
         logger.info("new channel with session_id {}", session_id)
-        self.channels[session_id] = Channel(session_id)
+        self.channels[session_id] = Channel(
+            session_id, size=self.channel_size, overflow=self.overflow
+        )
         return self.channels[session_id]
 
     def remove_channel(self, session_id):
         logger.info("remove channel for session {}", session_id)
         self.channels.pop(session_id, None)
 
+    async def broadcast(self, event: Event, session_ids: Optional[List[str]] = None):
+        """把同一个事件发送到多个通道, 默认为所有通道, 事件只序列化一次"""
+        for session_id in list(self.channels) if session_ids is None else session_ids:
+            await self.get_channel(session_id).put(event)
+
     async def send_connected_event(self, session_id):
         await self.get_channel(session_id).send_event("sse connected", level="success")
 
+    def gc(self):
+        now = time.monotonic()
+        for session_id, channel in list(self.channels.items()):
+            if channel.connections <= 0 and now - channel.last_active > self.idle_timeout:
+                self.remove_channel(session_id)
+
+    def start(self, interval: float = 60):
+        if self._gc_task and not self._gc_task.done():
+            return
+        self._gc_task = asyncio.get_running_loop().create_task(self._run_gc(interval))
+
+    async def _run_gc(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.gc()
+
 
 SSE_SERVICE = SSEService()
@@ -0,0 +1,149 @@
+import asyncio
+import dataclasses
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from loguru import logger
+
+from flick.core import node
+from flick.service import sse
+
+
+def _samplers(manager: node.NodeManager) -> Dict[str, Callable[[], Any]]:
+    """每个主题的采样函数, 列表类数据转换为以名称为键的字典, 便于计算增量"""
+    return {
+        "cpu": manager.cpu,
+        "memory": manager.memory,
+        "partitions": lambda: {
+            disk.mountpoint: disk.to_dict() for disk in manager.partitions()
+        },
+        "net_interfaces": lambda: {
+            interface.name: interface.to_dict() for interface in manager.net_interfaces()
+        },
+    }
+
+
+# 每个主题的采样间隔 (秒)
+TOPICS = {"cpu": 1, "memory": 1, "partitions": 10, "net_interfaces": 1}
+
+
+def diff(old: Any, new: Any) -> Any:
+    """计算两个字典的增量, 被删除的键值为 None, 没有变化时返回空字典"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    delta = {}
+    for key, value in new.items():
+        if key not in old:
+            delta[key] = value
+        elif old[key] != value:
+            delta[key] = diff(old[key], value)
+    for key in old:
+        if key not in new:
+            delta[key] = None
+    return delta
+
+
+@dataclasses.dataclass
+class Subscription:
+    session_id: str
+    topics: Set[str]
+    expires: float
+    # 已经发送过完整数据的主题
+    synced: Set[str] = dataclasses.field(default_factory=set)
+
+
+class TelemetryPublisher:
+    """节点监控数据推送
+
+    一个后台任务按主题定时采样, 每个主题每次只采样一次,
+    第一次向订阅者发送完整数据, 之后只发送增量。
+    同一帧的事件对象由所有订阅者共享, 增加订阅者几乎没有额外开销。
+    没有订阅者时采样任务退出。
+    """
+
+    def __init__(self, manager: node.NodeManager, tick: float = 1) -> None:
+        self.manager = manager
+        self.tick = tick
+        self.samplers = _samplers(manager)
+        self.subscriptions: Dict[str, Subscription] = {}
+        self._latest: Dict[str, Any] = {}
+        self._sampled_at: Dict[str, float] = {}
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, session_id: str, topics: Set[str], lease: float = 300):
+        """订阅 lease 秒, 到期前需要重新订阅; 重新订阅时会重新发送完整数据"""
+        logger.info("subscribe telemetry {}: {}", session_id, topics)
+        self.subscriptions[session_id] = Subscription(
+            session_id, set(topics), time.monotonic() + lease
+        )
+        if not self._task or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unsubscribe(self, session_id: str):
+        logger.info("unsubscribe telemetry {}", session_id)
+        self.subscriptions.pop(session_id, None)
+
+    def _active_topics(self) -> Set[str]:
+        topics: Set[str] = set()
+        for subscription in self.subscriptions.values():
+            topics |= subscription.topics
+        return topics
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.subscriptions:
+                now = time.monotonic()
+                for session_id, subscription in list(self.subscriptions.items()):
+                    if subscription.expires < now:
+                        self.unsubscribe(session_id)
+                for topic in self._active_topics():
+                    if now - self._sampled_at.get(topic, 0) < TOPICS[topic]:
+                        continue
+                    self._sampled_at[topic] = now
+                    try:
+                        # 采样可能阻塞 (例如分区), 放到线程池中执行
+                        value = await loop.run_in_executor(None, self.samplers[topic])
+                    except Exception:  # pylint: disable=broad-exception-caught
+                        logger.exception("sample telemetry {} failed", topic)
+                        continue
+                    await self._publish(topic, value)
+                await asyncio.sleep(self.tick)
+        finally:
+            self._latest.clear()
+            self._sampled_at.clear()
+
+    def _event(self, topic: str, full: bool, data: Any) -> sse.Event:
+        self._seq += 1
+        return sse.new_event(
+            "telemetry",
+            item={"topic": topic, "full": full, "seq": self._seq, "data": data},
+            topic="node",
+        )
+
+    async def _publish(self, topic: str, value: Any):
+        previous = self._latest.get(topic)
+        self._latest[topic] = value
+        delta_event = None
+        if previous is not None:
+            delta = diff(previous, value)
+            if delta:
+                delta_event = self._event(topic, False, delta)
+        full_targets: List[str] = []
+        delta_targets: List[str] = []
+        for subscription in list(self.subscriptions.values()):
+            if topic not in subscription.topics:
+                continue
+            if topic in subscription.synced:
+                delta_targets.append(subscription.session_id)
+            else:
+                full_targets.append(subscription.session_id)
+                subscription.synced.add(topic)
+        if full_targets:
+            await sse.SSE_SERVICE.broadcast(self._event(topic, True, value), full_targets)
+        if delta_event and delta_targets:
+            await sse.SSE_SERVICE.broadcast(delta_event, delta_targets)
+
+
+SERVICE = TelemetryPublisher(node.SERVICE)
@@ -1,17 +1,33 @@
+import asyncio
+import collections
 import contextlib
-import os
+import http
 import pathlib
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
+from urllib import parse
 
+import httpx
 from loguru import logger
 import pydantic
-import requests
 import tinydb
 from tinydb.table import Document
 
 from flick.common import utils
 
+try:
+    import h2  # noqa: F401  # pylint: disable=unused-import
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 请求状态
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
 
 class Response(pydantic.BaseModel):
     elapsed: float
@@ -19,6 +35,7 @@ class Response(pydantic.BaseModel):
     reason: str
     headers: Optional[dict] = None
     body: Optional[str] = None
+    http_version: Optional[str] = None
 
 
 class Request(pydantic.BaseModel):
@@ -28,6 +45,8 @@ class Request(pydantic.BaseModel):
     url: str
     headers: Optional[dict] = None
     body: Optional[str] = None
+    status: str = DONE
+    error: Optional[str] = None
 
     response: Optional[Response] = None
 
@@ -40,6 +59,8 @@ class Request(pydantic.BaseModel):
             url=doc.get("url", ""),
             headers=doc.get("headers", {}),
             body=doc.get("body"),
+            status=doc.get("status", DONE),
+            error=doc.get("error"),
             response=Response(**doc.get("response", {})) if doc.get("response") else None,
         )
 
@@ -68,26 +89,80 @@ class TinyDbImpl:
         with self._requests_table() as table:
             table.remove(doc_ids=[doc_id])
 
-    def update_request_response(self, doc_id: int, response: Response):
+    def update_request(self, request: Request):
+        """更新请求的状态和响应, 请求已被删除时忽略"""
         with self._requests_table() as table:
-            table.update({"response": response.model_dump()}, doc_ids=[doc_id])
+            if table.contains(doc_id=request.id):
+                table.update(request.model_dump(exclude={"id"}), doc_ids=[request.id])
 
 
 class WebRequestService:
+    """异步发送 HTTP 请求
 
-    def __init__(self) -> None:
+    每个目标主机使用独立的连接池并保持长连接, 空闲的连接池最多保留 max_hosts 个,
+    安装了 h2 时启用 HTTP/2。正在发送的请求可以通过 cancel 取消。
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 10,
+        read_timeout: float = 60 * 10,
+        max_connections_per_host: int = 10,
+        keepalive_expiry: float = 60,
+        max_hosts: int = 64,
+        http2: bool = True,
+    ) -> None:
         self.db_impl = TinyDbImpl()
-        self.timeout = 60 * 10  # 10 minutes
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_connections_per_host,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.max_hosts = max_hosts
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("h2 is not installed, web requests use HTTP/1.1")
+        self._clients: "collections.OrderedDict[str, httpx.AsyncClient]" = (
+            collections.OrderedDict()
+        )
+        # 每个连接池正在发送的请求数, 有请求的连接池不会被关闭
+        self._in_flight: Dict[str, int] = collections.Counter()
+        self._closing: Set[asyncio.Task] = set()
+        self._tasks: Dict[int, asyncio.Task] = {}
 
     def list_request(self) -> List[Request]:
         return self.db_impl.get_all()
 
     def delete_request(self, doc_id: int):
+        self.cancel(doc_id)
         self.db_impl.delete_by_id(doc_id)
 
-    def send_request(
+    @staticmethod
+    def _pool_key(url: str) -> str:
+        parsed = parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            raise ValueError(f"invalid url: {url}")
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _client(self, key: str) -> httpx.AsyncClient:
+        """按 scheme://host:port 获取连接池, 超过 max_hosts 时关闭最久未使用的空闲连接池"""
+        if key in self._clients:
+            self._clients.move_to_end(key)
+            return self._clients[key]
+        idle = [name for name in self._clients if not self._in_flight[name]]
+        for name in idle[:max(len(self._clients) - self.max_hosts + 1, 0)]:
+            task = asyncio.get_running_loop().create_task(self._clients.pop(name).aclose())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        self._clients[key] = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+        return self._clients[key]
+
+    def create_request(
         self, method: str, url: str, body: Optional[str] = None, headers: Optional[dict] = None
     ) -> Request:
+        """保存请求记录, 状态为 pending, 之后通过 send_request 发送"""
         request = Request(
             id=0,
             send_time=datetime.now().isoformat(),
@@ -95,26 +170,88 @@ class WebRequestService:
             url=url,
             headers=headers,
             body=body,
+            status=PENDING,
         )
         self.db_impl.insert(request)
+        return request
+
+    async def send_request(
+        self,
+        request: Request,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ) -> Request:
+        """发送请求并保存结果, 失败或取消时不抛出异常, 结果记录在 status 和 error 中"""
+        task = asyncio.ensure_future(
+            self._send(
+                request,
+                httpx.Timeout(
+                    read_timeout or self.read_timeout,
+                    connect=connect_timeout or self.connect_timeout,
+                ),
+            )
+        )
+        self._tasks[request.id] = task
+        try:
+            return await task
+        finally:
+            self._tasks.pop(request.id, None)
+
+    async def _send(self, request: Request, timeout: httpx.Timeout) -> Request:
         logger.info("Sending request: {} {}", request.method, request.url)
+        key = ""
         try:
-            raw_resp = requests.request(
-                method, url, headers=headers, data=body, timeout=self.timeout
+            pool = self._pool_key(request.url)
+            self._in_flight[pool] += 1
+            key = pool
+            client = self._client(key)
+            raw_resp = await client.request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                content=request.body or None,
+                timeout=timeout,
             )
-        except requests.exceptions.ConnectionError as e:
+        except asyncio.CancelledError:
+            logger.warning("Request {} cancelled", request.id)
+            request.status = CANCELLED
+        except (httpx.HTTPError, ValueError) as e:
             logger.error("Failed to send request: {}", e)
-            raise RuntimeError(f"Failed to send request: {e}") from e
-        response = Response(
-            elapsed=raw_resp.elapsed.total_seconds(),
-            status_code=raw_resp.status_code,
-            reason=raw_resp.reason,
-            headers=dict(raw_resp.headers),
-            body=raw_resp.content.decode("utf-8", errors="replace") if raw_resp.content else None,
-        )
-        request.response = response
-        self.db_impl.update_request_response(request.id, response)
+            request.status = FAILED
+            request.error = str(e) or e.__class__.__name__
+        else:
+            request.status = DONE
+            request.response = Response(
+                elapsed=raw_resp.elapsed.total_seconds(),
+                status_code=raw_resp.status_code,
+                reason=raw_resp.reason_phrase or _reason(raw_resp.status_code),
+                headers=dict(raw_resp.headers),
+                body=raw_resp.content.decode("utf-8", errors="replace")
+                if raw_resp.content else None,
+                http_version=raw_resp.http_version,
+            )
+        finally:
+            if key:
+                self._in_flight[key] -= 1
+                if not self._in_flight[key]:
+                    del self._in_flight[key]
+        self.db_impl.update_request(request)
         return request
 
+    def cancel(self, doc_id: int) -> bool:
+        task = self._tasks.get(doc_id)
+        if not task or task.done():
+            return False
+        task.cancel()
+        return True
+
+
+def _reason(status_code: int) -> str:
+    # HTTP/2 的响应没有 reason
+    try:
+        return http.HTTPStatus(status_code).phrase
+    except ValueError:
+        return ""
+
 
 SERVICE = WebRequestService()